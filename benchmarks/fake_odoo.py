@@ -0,0 +1,602 @@
+"""In-memory stand-ins for an old Odoo server reached with odoolib and for the env of a new one.
+
+They implement what cemigrate uses and nothing more, so the tool can be measured without two
+live instances. The fake server is reached through a real odoolib Connection: the results go
+through a json round trip like they would over JSON-RPC.
+"""
+import re
+import json
+import time
+import bisect
+import itertools
+
+from odoolib import Connection
+from odoolib.main import Connector, JsonRPCException
+
+# {hostname: FakeServer}, so connections cloned from their url reach the same data
+SERVERS = {}
+
+
+def _value(value):
+    """many2one values are [id, name] on the server, compare their id"""
+    if isinstance(value, (list, tuple)) and len(value) == 2 and isinstance(value[0], int) and \
+            isinstance(value[1], str):
+        return value[0]
+    return value
+
+
+def _leaf(field_name, operator, value):
+    if operator in ('in', 'not in'):
+        values = set(value)
+        if False in values:
+            values.add(None)
+        if operator == 'in':
+            return lambda row: _value(row.get(field_name)) in values
+        return lambda row: _value(row.get(field_name)) not in values
+    if operator == '=':
+        if value is False:
+            return lambda row: row.get(field_name) in (False, None)
+        return lambda row: _value(row.get(field_name)) == value
+    if operator == '!=':
+        if value is False:
+            return lambda row: row.get(field_name) not in (False, None)
+        return lambda row: _value(row.get(field_name)) != value
+    compare = {
+        '>': lambda a: a > value, '>=': lambda a: a >= value,
+        '<': lambda a: a < value, '<=': lambda a: a <= value,
+    }[operator]
+
+    def leaf(row):
+        current = _value(row.get(field_name))
+        return current not in (False, None) and compare(current)
+    return leaf
+
+
+def compile_domain(domain, fields):
+    """Return (list of the leaves and-ed at the top level, list of predicates, one per top level term)"""
+    items = list(domain)
+    position = 0
+    leaves, predicates = [], []
+
+    def term():
+        nonlocal position
+        item = items[position]
+        position += 1
+        if item == '|':
+            first, second = term(), term()
+            return lambda row: first(row) or second(row)
+        if item == '&':
+            first, second = term(), term()
+            return lambda row: first(row) and second(row)
+        if item == '!':
+            negated = term()
+            return lambda row: not negated(row)
+        field_name, operator, value = item
+        if field_name != 'id' and field_name not in fields:
+            raise JsonRPCException({'message': 'Invalid field %s in leaf %r' % (field_name, tuple(item))})
+        return _leaf(field_name, operator, value)
+
+    while position < len(items):
+        item = items[position]
+        if isinstance(item, (list, tuple)):
+            leaves.append(tuple(item))
+        predicates.append(term())
+    return leaves, predicates
+
+
+def _mentions_active(domain):
+    return any(isinstance(item, (list, tuple)) and item[0] == 'active' for item in domain)
+
+
+class FakeServer(object):
+    """Tables of an old server: {model name: [rows ordered by id]} and {model name: {field: (type, relation)}}.
+
+    Many2one values are [id, name] like Odoo returns them, many2many values are lists of ids.
+    latency is added to every call, in seconds.
+    """
+
+    def __init__(self, name='fake-odoo', database='v12', latency=0.0, serialize=True):
+        self.name = name
+        self.database = database
+        self.latency = latency
+        self.serialize = serialize
+        self.tables = {}
+        self.indexes = {}
+        self.fields = {}
+        self.calls = 0
+        SERVERS[name] = self
+        self.add_model('ir.model.fields', {'name': 'char', 'model': 'char', 'ttype': 'char', 'relation': 'char',
+                                           'relation_field': 'char', 'domain': 'char'})
+        self.add_model('ir.module.module', {'name': 'char', 'state': 'char', 'latest_version': 'char'})
+        self.add_rows('ir.module.module', [{'id': 1, 'name': 'base', 'state': 'installed', 'latest_version': '12.0'}])
+
+    def add_model(self, model_name, fields):
+        """fields is {field name: type, (type, relation) or (type, relation, inverse field)}"""
+        self.fields[model_name] = {name: (spec + (False,) * 2)[:3] if isinstance(spec, tuple) else (spec, False, False)
+                                   for name, spec in fields.items()}
+        self.tables.setdefault(model_name, [])
+        self.indexes[model_name] = {}
+        if model_name != 'ir.model.fields':
+            self.add_rows('ir.model.fields', [
+                {'id': len(self.tables['ir.model.fields']) + 1 + i, 'model': model_name, 'name': name,
+                 'ttype': ttype, 'relation': relation, 'relation_field': relation_field, 'domain': '[]'}
+                for i, (name, (ttype, relation, relation_field)) in enumerate(
+                    sorted(self.fields[model_name].items()))])
+
+    def add_rows(self, model_name, rows):
+        """Append rows, their ids must be greater than the ids already there"""
+        table, index = self.tables[model_name], self.indexes[model_name]
+        for row in rows:
+            index[row['id']] = len(table)
+            table.append(row)
+
+    def connect(self, login='admin', password='admin'):
+        return Connection(FakeConnector(self.name, 8069), self.database, login, password)
+
+    # ------------------------------------------------------------------ model methods
+    def _search(self, model_name, domain, offset=0, limit=None, order=None):
+        fields = self.fields[model_name]
+        domain = list(domain or [])
+        if 'active' in fields and not _mentions_active(domain):
+            domain.append(('active', '=', True))
+        leaves, predicates = compile_domain(domain, fields)
+        table = self.tables[model_name]
+        for field_name, operator, value in leaves:
+            if field_name == 'id' and operator == 'in':
+                # only the rows of these ids, instead of scanning the table
+                index = self.indexes[model_name]
+                table = [table[index[record_id]] for record_id in sorted(set(value)) if record_id in index]
+                break
+        start = 0
+        for field_name, operator, value in leaves:
+            # keyset pagination: start after the last id instead of scanning the table
+            if field_name == 'id' and operator in ('>', '>='):
+                start = max(start, bisect.bisect_right(_Ids(table), value) if operator == '>' else
+                            bisect.bisect_left(_Ids(table), value))
+        if order and order.split()[0] != 'id' or order and 'desc' in order.lower():
+            rows = [row for row in table[start:] if all(p(row) for p in predicates)]
+            key = order.split()[0]
+            rows.sort(key=lambda row: (row.get(key) in (False, None), _value(row.get(key)) or 0),
+                      reverse='desc' in order.lower())
+            rows = rows[offset or 0:]
+            return [row['id'] for row in (rows[:limit] if limit else rows)]
+        res, skip = [], offset or 0
+        for row in itertools.islice(table, start, None):
+            if all(p(row) for p in predicates):
+                if skip:
+                    skip -= 1
+                    continue
+                res.append(row['id'])
+                if limit and len(res) >= limit:
+                    break
+        return res
+
+    def search(self, model_name, domain=None, offset=0, limit=None, order=None, context=None):
+        return self._search(model_name, domain, offset, limit, order)
+
+    def search_count(self, model_name, domain=None, context=None):
+        return len(self._search(model_name, domain))
+
+    def read(self, model_name, ids, fields=None, context=None):
+        table, index = self.tables[model_name], self.indexes[model_name]
+        res = []
+        for record_id in ids:
+            position = index.get(record_id)
+            if position is None:
+                continue
+            row = table[position]
+            if fields:
+                row = dict({name: row.get(name, False) for name in fields}, id=record_id)
+            res.append(row)
+        return res
+
+    def execute(self, model_name, method, args, kwargs):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if model_name not in self.tables:
+            raise JsonRPCException({'message': "Object %s doesn't exist" % model_name})
+        if method not in ('search', 'search_count', 'read'):
+            raise JsonRPCException({'message': 'Method %s not implemented by the fake server' % method})
+        res = getattr(self, method)(model_name, *args, **kwargs)
+        return json.loads(json.dumps(res)) if self.serialize else [
+            dict(row) if isinstance(row, dict) else row for row in res] if isinstance(res, list) else res
+
+
+class _Ids(object):
+    """Sequence of the ids of a table ordered by id, for bisect"""
+    __slots__ = ('table',)
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, position):
+        return self.table[position]['id']
+
+
+class FakeConnector(Connector):
+    """odoolib connector calling a FakeServer instead of sending requests"""
+    PROTOCOL = 'fake'
+
+    def __init__(self, hostname, port=8069):
+        self.server = SERVERS[hostname]
+        self.url = 'http://%s:%d/jsonrpc' % (hostname, port)
+
+    def send(self, service_name, method, *args):
+        if service_name == 'common' and method == 'login':
+            return 1
+        if service_name == 'object' and method == 'execute_kw':
+            _database, _uid, _password, model_name, model_method, model_args, model_kwargs = args
+            return self.server.execute(model_name, model_method, model_args, model_kwargs)
+        raise JsonRPCException({'message': '%s.%s not implemented by the fake server' % (service_name, method)})
+
+
+# ---------------------------------------------------------------------- local env
+class FakeField(object):
+    def __init__(self, name, ttype, relation=False, index=False, relation_field=False):
+        self.name = name
+        self.type = ttype
+        self.comodel_name = relation
+        self.inverse_name = relation_field
+        self.index = index
+        self.store = True
+        self.inherited = False
+        self.translate = False
+
+
+class FakeCursor(object):
+    """Commits and rollbacks of the FakeEnv, and the few SQL queries cemigrate runs"""
+    ID_MAP = re.compile(r'SELECT "(\w+)", id FROM "?(\w+)"? WHERE "\w+" (> 0|= ANY\(%s\))(?: ORDER BY (.*))?$')
+    MAX = re.compile(r'SELECT max\("(\w+)"\) FROM "?(\w+)"? WHERE model = %s$')
+
+    def __init__(self, env):
+        self.env = env
+        self.commits = 0
+        self.rollbacks = 0
+        self.result = []
+
+    def commit(self):
+        self.commits += 1
+        self.env.journal = []
+        self.env.touched = set()
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.env.undo()
+
+    def close(self):
+        pass
+
+    def execute(self, query, params=None):
+        query = ' '.join(query.split())
+        self.result = []
+        match = self.ID_MAP.match(query)
+        if match:
+            field_name, table, condition, order = match.groups()
+            rs = self.env[self.env.tables[table]]
+            if condition == '> 0':
+                rows = [row for row in self.env.data[rs._name].values() if (row.get(field_name) or 0) > 0]
+            else:
+                rows = [self.env.data[rs._name][record_id]
+                        for record_id in rs._lookup((field_name,), [(value,) for value in params[0]])]
+            if order and order.startswith('active'):
+                rows.sort(key=lambda row: (bool(row.get('active')), row['id']))
+            else:
+                rows.sort(key=lambda row: row['id'])
+            self.result = [(row[field_name], row['id']) for row in rows]
+            return
+        match = self.MAX.match(query)
+        if match:
+            field_name, table = match.groups()
+            rs = self.env[self.env.tables[table]]
+            values = [self.env.data[rs._name][record_id].get(field_name) or 0
+                      for record_id in rs._lookup(('model',), [(params[0],)])]
+            self.result = [(max(values) or None if values else None,)]
+            return
+        if query.startswith('SELECT 1 FROM pg_indexes'):
+            self.result = [(1,)] if params[0] in self.env.sql_indexes else []
+        elif query.startswith('CREATE') and ' INDEX ' in query:
+            self.env.sql_indexes.add(query.split('"')[1])
+        elif query.startswith('DROP INDEX'):
+            self.env.sql_indexes.discard(query.split('"')[1])
+        elif 'pg_advisory_xact_lock' not in query:
+            raise NotImplementedError('Query not supported by the fake env: %s' % query)
+
+    def fetchall(self):
+        return self.result
+
+    def fetchone(self):
+        return self.result and self.result[0] or None
+
+
+class FakeEnv(object):
+    """In-memory env: {model name: {id: row}}, rolled back with a journal of the rows changed since the
+    last commit. Equality searches use hash indexes built on demand.
+    """
+
+    def __init__(self, models):
+        self.data = {}
+        self.fields = {}
+        # {table name: model name}
+        self.tables = {}
+        # {model name: {field names: {values: set of ids}}}
+        self.indexes = {}
+        self.sql_indexes = set()
+        self.sequence = itertools.count(1)
+        self.journal = []
+        self.touched = set()
+        self.context = {}
+        self.uid = 1
+        self.registry = self
+        self.cr = FakeCursor(self)
+        for model_name, fields in models.items():
+            self.add_model(model_name, fields)
+        self.add_model('mail.message', {
+            'model': 'char', 'res_id': 'integer', 'author_id': ('many2one', 'res.partner'), 'subject': 'char',
+            'body': 'html', 'email_from': 'char', 'reply_to': 'char', 'message_type': 'selection',
+            'message_id': 'char', 'description': 'char', 'date': 'datetime',
+            'parent_id': ('many2one', 'mail.message')})
+
+    def add_model(self, model_name, fields):
+        self.data.setdefault(model_name, {})
+        self.tables[model_name.replace('.', '_')] = model_name
+        self.indexes[model_name] = {}
+        self.fields[model_name] = {'id': FakeField('id', 'integer')}
+        for field_name, spec in fields.items():
+            ttype, relation, relation_field = (spec + (False,) * 2)[:3] if isinstance(spec, tuple) else (
+                spec, False, False)
+            self.fields[model_name][field_name] = FakeField(field_name, ttype, relation, relation_field=relation_field)
+
+    def __getitem__(self, model_name):
+        if model_name == 'ir.model':
+            return FakeIrModel(self)
+        if model_name == 'ir.model.fields':
+            return FakeIrModelFields(self)
+        if model_name == 'ir.config_parameter':
+            return FakeConfigParameter()
+        return FakeRecordset(self, model_name, ())
+
+    def flush_all(self):
+        pass
+
+    def invalidate_all(self):
+        pass
+
+    def save(self, model_name, record_id):
+        """Keep the row as it is before changing it, for rollback"""
+        if (model_name, record_id) not in self.touched:
+            self.touched.add((model_name, record_id))
+            row = self.data[model_name].get(record_id)
+            self.journal.append((model_name, record_id, row and dict(row)))
+
+    def undo(self):
+        for model_name, record_id, row in reversed(self.journal):
+            if row is None:
+                self.data[model_name].pop(record_id, None)
+            else:
+                self.data[model_name][record_id] = row
+            self.indexes[model_name] = {}
+        self.journal = []
+        self.touched = set()
+
+
+class FakeRecordset(object):
+    def __init__(self, env, model_name, ids, context=None):
+        self.env = env
+        self._name = model_name
+        self._ids = tuple(ids)
+        self._context = context or {}
+
+    @property
+    def _fields(self):
+        return self.env.fields[self._name]
+
+    @property
+    def _table(self):
+        return self._name.replace('.', '_')
+
+    @property
+    def ids(self):
+        return list(self._ids)
+
+    @property
+    def id(self):
+        return self._ids and self._ids[0] or False
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __bool__(self):
+        return bool(self._ids)
+
+    def __iter__(self):
+        return (FakeRecordset(self.env, self._name, [record_id], self._context) for record_id in self._ids)
+
+    def __getitem__(self, position):
+        return FakeRecordset(self.env, self._name, [self._ids[position]], self._context)
+
+    def __repr__(self):
+        return '%s%r' % (self._name, self._ids)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self.env.fields.get(self._name, {}):
+            raise AttributeError(name)
+        value = self._ids and self.env.data[self._name][self._ids[0]].get(name, False)
+        field = self._fields[name]
+        if field.type in ('many2one', 'many2many'):
+            return FakeRecordset(self.env, field.comodel_name, value and (
+                value if isinstance(value, list) else [value]) or [])
+        return value
+
+    def __setattr__(self, name, value):
+        if name.startswith('_') or name == 'env':
+            object.__setattr__(self, name, value)
+        else:
+            self.write({name: value})
+
+    def with_context(self, *args, **kwargs):
+        context = dict(self._context, **(args and args[0] or {}), **kwargs)
+        return FakeRecordset(self.env, self._name, self._ids, context)
+
+    def sudo(self):
+        return self
+
+    def browse(self, ids=()):
+        if isinstance(ids, int):
+            ids = [ids]
+        return FakeRecordset(self.env, self._name, [record_id for record_id in ids or () if record_id],
+                             self._context)
+
+    # ------------------------------------------------------------------ indexes
+    def _index(self, field_names):
+        indexes = self.env.indexes[self._name]
+        index = indexes.get(field_names)
+        if index is None:
+            index = indexes[field_names] = {}
+            for row in self.env.data[self._name].values():
+                index.setdefault(tuple(row.get(f, False) for f in field_names), set()).add(row['id'])
+        return index
+
+    def _lookup(self, field_names, keys):
+        index = self._index(field_names)
+        return sorted(set().union(*[index.get(key, ()) for key in keys]))
+
+    def _reindex(self, row, old_row=None):
+        for field_names, index in self.env.indexes[self._name].items():
+            if old_row is not None:
+                index.get(tuple(old_row.get(f, False) for f in field_names), set()).discard(row['id'])
+            index.setdefault(tuple(row.get(f, False) for f in field_names), set()).add(row['id'])
+
+    # ------------------------------------------------------------------ orm
+    def _convert(self, vals):
+        res = {}
+        for field_name, value in vals.items():
+            field = self._fields.get(field_name)
+            if field is None:
+                raise ValueError('Invalid field %r on model %r' % (field_name, self._name))
+            if field.type == 'many2one':
+                value = _value(value) or False
+            elif field.type == 'many2many' and value and isinstance(value[0], (list, tuple)):
+                # only (6, 0, ids)
+                value = sorted(value[-1][2])
+            res[field_name] = value
+        return res
+
+    def search(self, domain, limit=None, order=None):
+        fields = self._fields
+        domain = list(domain)
+        if 'active' in fields and not _mentions_active(domain) and self._context.get('active_test', True):
+            domain.append(('active', '=', True))
+        leaves, predicates = compile_domain(domain, fields)
+        equal = tuple(sorted((f, v) for f, op, v in leaves if op == '=' and f != 'active'))
+        among = [(f, v) for f, op, v in leaves if op == 'in' and f != 'id']
+        if equal:
+            candidates = self._lookup(tuple(f for f, v in equal), [tuple(v for f, v in equal)])
+        elif among:
+            candidates = self._lookup((among[0][0],), [(v,) for v in among[0][1]])
+        else:
+            candidates = sorted(self.env.data[self._name])
+        rows = self.env.data[self._name]
+        ids = [record_id for record_id in candidates if all(p(rows[record_id]) for p in predicates)]
+        return FakeRecordset(self.env, self._name, ids[:limit] if limit else ids, self._context)
+
+    def search_read(self, domain, fields=None, order=None):
+        return self.search(domain).read(fields)
+
+    def read(self, fields=None):
+        rows = self.env.data[self._name]
+        fields = fields or [f for f in self._fields if f != 'id']
+        return [dict({f: rows[record_id].get(f, False) for f in fields}, id=record_id) for record_id in self._ids]
+
+    def create(self, vals_list):
+        single = isinstance(vals_list, dict)
+        ids = []
+        for vals in single and [vals_list] or vals_list:
+            row = dict(self._convert(vals), id=next(self.env.sequence))
+            if 'active' in self._fields:
+                row.setdefault('active', True)
+            # journaled as missing, rollback deletes it
+            self.env.save(self._name, row['id'])
+            self.env.data[self._name][row['id']] = row
+            self._reindex(row)
+            ids.append(row['id'])
+        return FakeRecordset(self.env, self._name, ids, self._context)
+
+    def write(self, vals):
+        vals = self._convert(vals)
+        rows = self.env.data[self._name]
+        for record_id in self._ids:
+            self.env.save(self._name, record_id)
+            old_row = dict(rows[record_id])
+            rows[record_id].update(vals)
+            self._reindex(rows[record_id], old_row)
+        return True
+
+    def unlink(self):
+        for record_id in self._ids:
+            self.env.save(self._name, record_id)
+            self.env.data[self._name].pop(record_id, None)
+        self.env.indexes[self._name] = {}
+        return True
+
+    def flush_recordset(self):
+        pass
+
+    def invalidate_recordset(self):
+        pass
+
+    @property
+    def message_ids(self):
+        return FakeRecordset(self.env, 'mail.message', self.env['mail.message']._lookup(
+            ('model', 'res_id'), [(self._name, record_id) for record_id in self._ids]))
+
+    def message_post(self, **kwargs):
+        vals = {k: v for k, v in kwargs.items() if k in self.env.fields['mail.message']}
+        return self.env['mail.message'].create(dict(vals, model=self._name, res_id=self.id))
+
+
+class FakeIrModel(object):
+    def __init__(self, env):
+        self.env = env
+
+    def search(self, domain):
+        return FakeIrModelRecord(self.env, dict((leaf[0], leaf[2]) for leaf in domain)['model'])
+
+
+class FakeIrModelRecord(object):
+    def __init__(self, env, model_name):
+        self.env = env
+        self.id = self.model = model_name
+
+    def write(self, vals):
+        for _command, _id, data in vals['field_id']:
+            self.env.fields[self.model][data['name']] = FakeField(
+                data['name'], data['ttype'], index=data.get('index', False))
+
+
+class FakeIrModelFields(object):
+    def __init__(self, env):
+        self.env = env
+
+    def search(self, domain):
+        conditions = dict((leaf[0], leaf[2]) for leaf in domain)
+        if 'model_id' in conditions:
+            field = self.env.fields[conditions['model_id']].get(conditions['name'])
+            return field or False
+        return []
+
+    def search_read(self, domain, fields):
+        model_name = dict((leaf[0], leaf[2]) for leaf in domain)['model']
+        return [{'name': f.name, 'ttype': f.type, 'relation': f.comodel_name, 'relation_field': f.inverse_name,
+                 'domain': '[]'} for f in self.env.fields[model_name].values() if f.name != 'id']
+
+
+class FakeConfigParameter(object):
+    def sudo(self):
+        return self
+
+    def set_param(self, key, value):
+        pass
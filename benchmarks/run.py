@@ -0,0 +1,210 @@
+"""Offline benchmark of the import phases, against the in-memory server and env of fake_odoo.
+
+    python -m benchmarks.run --rows 10000 --rows 100000 --rows 1000000 --latency 5
+
+Each scale runs in its own process so its peak memory is measured alone. For each phase the wall
+time, the records per second and the split between reading the old server (rpc), the local ORM (orm)
+and the commits are printed, --json writes them to a file to compare runs.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from cemigrate import MigrateToolBase, Metrics, CommitPolicy
+
+from .fake_odoo import FakeServer, FakeEnv
+
+COUNTRIES = 250
+TAGS = 50
+
+CONFIG = {
+    'res.country': {'create': False, 'include_archived': False, 'key_fields': ['code'],
+                    'new_model_name': 'res.country'},
+    'res.partner': {'create': True, 'include_archived': True, 'key_fields': ['name', 'type'],
+                    'new_model_name': 'res.partner'},
+    'crm.lead.tag': {'create': True, 'include_archived': False, 'key_fields': ['name'], 'new_model_name': 'crm.tag'},
+    'crm.lead': {'create': True, 'include_archived': False, 'key_fields': ['name'], 'new_model_name': 'crm.lead'},
+}
+
+# (phase, model name, args), in the order of a real migration
+PHASES = [
+    ('init_import_models', 'res.country', ()),
+    ('init_import_models', 'res.partner', ()),
+    ('import_basic_types', 'res.partner', (['customer'],)),
+    ('update_many2one_fields', 'res.partner', (['country_id', 'parent_id'],)),
+    ('init_import_models', 'crm.lead.tag', ()),
+    ('init_import_models', 'crm.lead', ()),
+    ('import_basic_types', 'crm.lead', ()),
+    ('update_many2one_fields', 'crm.lead', (['partner_id', 'country_id'],)),
+    ('update_many2many_fields', 'crm.lead', (['tag_ids'],)),
+    ('copy_chatter', 'crm.lead', ()),
+]
+
+
+class BenchTool(MigrateToolBase):
+    def transform_res_partner(self, vals, key_fields):
+        vals['customer_rank'] = vals.pop('customer', False) and 1 or 0
+        return vals, key_fields
+
+
+def build_server(rows, latency):
+    """Old server with `rows` partners, leads and messages"""
+    server = FakeServer(latency=latency)
+    server.add_model('res.country', {'code': 'char', 'name': 'char'})
+    server.add_model('res.partner', {
+        'name': 'char', 'type': 'selection', 'active': 'boolean', 'email': 'char', 'city': 'char',
+        'customer': 'boolean', 'country_id': ('many2one', 'res.country'), 'parent_id': ('many2one', 'res.partner')})
+    server.add_model('crm.lead.tag', {'name': 'char'})
+    server.add_model('crm.lead', {
+        'name': 'char', 'description': 'text', 'partner_id': ('many2one', 'res.partner'),
+        'country_id': ('many2one', 'res.country'), 'tag_ids': ('many2many', 'crm.lead.tag'),
+        'message_ids': ('one2many', 'mail.message')})
+    server.add_model('mail.message', {
+        'model': 'char', 'res_id': 'integer', 'author_id': ('many2one', 'res.partner'), 'subject': 'char',
+        'body': 'html', 'email_from': 'char', 'reply_to': 'char', 'message_type': 'selection',
+        'message_id': 'char', 'description': 'char', 'date': 'datetime', 'parent_id': ('many2one', 'mail.message')})
+    server.add_rows('res.country', [{'id': i, 'code': 'C%03d' % i, 'name': 'Country %d' % i}
+                                    for i in range(1, COUNTRIES + 1)])
+    server.add_rows('res.partner', [
+        {'id': i, 'name': 'Partner %d' % i, 'type': 'contact', 'active': i % 20 != 0, 'email': 'p%d@example.com' % i,
+         'city': 'City %d' % (i % 100), 'customer': i % 2 == 0,
+         'country_id': [i % COUNTRIES + 1, 'Country %d' % (i % COUNTRIES + 1)],
+         # about 10% of the partners are contacts of a company created before them
+         'parent_id': i > 10 and i % 10 == 0 and [i // 10, 'Partner %d' % (i // 10)] or False}
+        for i in range(1, rows + 1)])
+    server.add_rows('crm.lead.tag', [{'id': i, 'name': 'Tag %d' % i} for i in range(1, TAGS + 1)])
+    server.add_rows('crm.lead', [
+        {'id': i, 'name': 'Lead %d' % i, 'description': 'Description of lead %d' % i,
+         'partner_id': [i, 'Partner %d' % i], 'country_id': [i % COUNTRIES + 1, 'Country'],
+         'tag_ids': [i % TAGS + 1, (i + 7) % TAGS + 1], 'message_ids': [i]}
+        for i in range(1, rows + 1)])
+    server.add_rows('mail.message', [
+        {'id': i, 'model': 'crm.lead', 'res_id': i, 'author_id': [i, 'Partner %d' % i], 'subject': 'Subject %d' % i,
+         'body': '<p>Message %d</p>' % i, 'email_from': 'p%d@example.com' % i, 'reply_to': False,
+         'message_type': 'comment', 'message_id': '<%d@example.com>' % i, 'description': False,
+         'date': '2022-01-01 00:00:00', 'parent_id': False}
+        for i in range(1, rows + 1)])
+    return server
+
+
+def build_env(existing=0):
+    """New database with the countries, and `existing` partners to match by name"""
+    env = FakeEnv({
+        'res.country': {'code': 'char', 'name': 'char'},
+        'res.partner': {'name': 'char', 'type': 'selection', 'active': 'boolean', 'email': 'char', 'city': 'char',
+                        'customer_rank': 'integer', 'country_id': ('many2one', 'res.country'),
+                        'parent_id': ('many2one', 'res.partner')},
+        'crm.tag': {'name': 'char'},
+        'crm.lead': {'name': 'char', 'description': 'text', 'partner_id': ('many2one', 'res.partner'),
+                     'country_id': ('many2one', 'res.country'), 'tag_ids': ('many2many', 'crm.tag'),
+                     'message_ids': ('one2many', 'mail.message')},
+    })
+    env['res.country'].create([{'code': 'C%03d' % i, 'name': 'Country %d' % i} for i in range(1, COUNTRIES + 1)])
+    env['res.partner'].create([{'name': 'Partner %d' % i, 'type': 'contact', 'active': i % 20 != 0}
+                               for i in range(1, existing + 1)])
+    env.cr.commit()
+    return env
+
+
+def peak_memory_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_scale(args):
+    """Run all the phases at one scale, in this process"""
+    with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as config_file:
+        config_file.write(repr({model_name: dict(info, page_size=args.page_size,
+                                                 create_batch_size=args.create_batch_size)
+                                for model_name, info in CONFIG.items()}))
+    os.environ['CEMIG_CONFIG'] = config_file.name
+    started = time.perf_counter()
+    server = build_server(args.rows, args.latency / 1000.0)
+    env = build_env(args.existing)
+    setup = time.perf_counter() - started
+    metrics = Metrics()
+    tool = BenchTool(env, server.connect(), commit_policy=CommitPolicy(records=args.commit_records),
+                     prefetch_workers=args.prefetch_workers, metrics=metrics)
+    res = {'rows': args.rows, 'setup_seconds': round(setup, 2), 'setup_peak_mb': peak_memory_mb(), 'phases': []}
+    try:
+        for phase, model_name, phase_args in PHASES:
+            if phase == 'copy_chatter':
+                phase_args = (args.chatter == 'bulk',)
+            calls = server.calls
+            started = time.perf_counter()
+            getattr(tool, phase)(model_name, *phase_args)
+            wall = time.perf_counter() - started
+            stats = metrics.as_dict().get(model_name, {}).get(phase, {})
+            res['phases'].append({
+                'phase': phase, 'model': model_name, 'wall_seconds': round(wall, 3),
+                'records': stats.get('records', 0),
+                'records_per_second': round(stats.get('records', 0) / wall, 1) if wall else 0,
+                'rpc_seconds': round(stats.get('rpc_seconds', 0), 3),
+                'orm_seconds': round(stats.get('orm_seconds', 0), 3),
+                'commit_seconds': round(stats.get('commit_seconds', 0), 3),
+                'rpc_calls': server.calls - calls, 'peak_mb': peak_memory_mb()})
+    finally:
+        os.unlink(config_file.name)
+    return res
+
+
+def print_scale(res):
+    print('\n%s rows (setup %.1fs, %.1f MB)' % (res['rows'], res['setup_seconds'], res['setup_peak_mb']))
+    print('%-24s %-13s %9s %9s %10s %8s %8s %8s %7s %9s' % (
+        'phase', 'model', 'records', 'wall s', 'rec/s', 'rpc s', 'orm s', 'commit s', 'calls', 'peak MB'))
+    for phase in res['phases']:
+        print('%(phase)-24s %(model)-13s %(records)9d %(wall_seconds)9.2f %(records_per_second)10.1f '
+              '%(rpc_seconds)8.2f %(orm_seconds)8.2f %(commit_seconds)8.2f %(rpc_calls)7d %(peak_mb)9.1f' % phase)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, action='append',
+                        help='partners, leads and messages of the old server, repeat for several scales '
+                             '(default 10000, 100000 and 1000000)')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds added to each remote call')
+    parser.add_argument('--page-size', type=int, default=MigrateToolBase.PAGE_SIZE)
+    parser.add_argument('--create-batch-size', type=int, default=500)
+    parser.add_argument('--commit-records', type=int, default=CommitPolicy().records)
+    parser.add_argument('--prefetch-workers', type=int, default=0)
+    parser.add_argument('--existing', type=int, default=0,
+                        help='partners already in the new database, matched by init_import_models')
+    parser.add_argument('--chatter', choices=('bulk', 'post'), default='bulk',
+                        help='copy_chatter with copy_chatter_bulk or message_post')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the MIG log')
+    # set when running one scale in a child process, the results are written to this file
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.verbose and logging.INFO or logging.WARNING)
+    if args.result:
+        with open(args.result, 'w') as result_file:
+            json.dump(run_scale(argparse.Namespace(**dict(vars(args), rows=args.rows[0]))), result_file)
+        return
+    results = []
+    for rows in args.rows or [10000, 100000, 1000000]:
+        with tempfile.NamedTemporaryFile(suffix='.json') as result_file:
+            command = [sys.executable, '-m', 'benchmarks.run', '--result', result_file.name, '--rows', str(rows)] + [
+                option for name in ('latency', 'page_size', 'create_batch_size', 'commit_records',
+                                    'prefetch_workers', 'existing', 'chatter')
+                for option in ('--%s' % name.replace('_', '-'), str(getattr(args, name)))] + (
+                args.verbose and ['--verbose'] or [])
+            # the tool prints its progress, keep it out of the report
+            subprocess.run(command, stdout=subprocess.DEVNULL, check=True,
+                           cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            results.append(json.load(result_file))
+        print_scale(results[-1])
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,12 @@
 from .migrate_tool import *
+from .batch import *
+from .metadata import *
+from .checkpoint import *
+from .prefetch import *
+from .partition import *
+from .scheduler import *
+from .metrics import *
+from .snapshot import *
+from .transport import *
+from .sqlbatch import *
+from .attachments import *
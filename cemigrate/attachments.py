@@ -0,0 +1,172 @@
+import os
+import base64
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .prefetch import clone_connection
+
+_logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20
+
+
+def filestore_path(filestore, checksum):
+    """(store_fname, full path) of the content of checksum, as ir.attachment._get_path names it"""
+    # files written by old versions are kept where they are
+    fname = '%s/%s' % (checksum[:3], checksum)
+    if os.path.isfile(os.path.join(filestore, fname)):
+        return fname, os.path.join(filestore, fname)
+    fname = '%s/%s' % (checksum[:2], checksum)
+    return fname, os.path.join(filestore, fname)
+
+
+class AttachmentDownloader(object):
+    """Copy the content of remote attachments into the local filestore, `workers` at a time.
+
+    With mode='http' the content is streamed from /web/content of the old server in chunks of CHUNK_SIZE,
+    through a web session per thread, so memory stays flat whatever the size of the files. With mode='rpc'
+    it's read from the datas field, one attachment per call: a whole file per worker is held in memory.
+
+    Contents are written to a temporary file of the filestore while their sha1 is computed, then moved to
+    their place. A content already in the filestore, checked by the remote checksum before downloading and
+    by the computed one after, is not written twice.
+
+    The threads, and so their sessions, live as long as the downloader: close it, or use it as a context manager.
+    """
+
+    def __init__(self, connection, filestore, workers=4, mode='http', timeout=600):
+        if mode not in ('http', 'rpc'):
+            raise ValueError("mode must be 'http' or 'rpc', not %r" % mode)
+        self.connection = connection
+        self.filestore = filestore
+        self.workers = workers
+        self.mode = mode
+        self.timeout = timeout
+        url = urlsplit(connection.connector.url)
+        self.base_url = '%s://%s' % (url.scheme, url.netloc)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.files = 0
+        self.bytes_downloaded = 0
+        self.bytes_deduplicated = 0
+        self.executor = ThreadPoolExecutor(workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    # ------------------------------------------------------------------ remote
+    def _authenticate(self, session):
+        response = session.post(self.base_url + '/web/session/authenticate', json={
+            'jsonrpc': '2.0', 'method': 'call', 'params': {
+                'db': self.connection.database, 'login': self.connection.login,
+                'password': self.connection.password}}, timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()
+        if result.get('error') or not (result.get('result') or {}).get('uid'):
+            raise requests.HTTPError('Authentication on %s failed: %s' % (self.base_url, result.get('error')))
+
+    @property
+    def session(self):
+        """Web session of the current thread, logged in on the old server"""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            self._authenticate(session)
+        return session
+
+    def _iter_http(self, attachment_id):
+        for attempt in range(2):
+            response = self.session.get('%s/web/content/%d' % (self.base_url, attachment_id),
+                                        params={'download': 'true'}, stream=True, timeout=self.timeout)
+            if '/web/login' in response.url and not attempt:
+                # the session expired
+                response.close()
+                self._authenticate(self.session)
+                continue
+            response.raise_for_status()
+            yield from response.iter_content(CHUNK_SIZE)
+            return
+
+    def _iter_rpc(self, attachment_id):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = clone_connection(self.connection)
+        [rec] = connection.get_model('ir.attachment').read([attachment_id], ['datas'])
+        yield base64.b64decode(rec['datas'] or b'')
+
+    # ------------------------------------------------------------------ local
+    def _store(self, attachment):
+        """Return (store_fname, checksum, file_size) of the attachment content, stored in the filestore"""
+        checksum = attachment.get('checksum')
+        if checksum:
+            fname, full_path = filestore_path(self.filestore, checksum)
+            if os.path.isfile(full_path):
+                with self.lock:
+                    self.bytes_deduplicated += os.path.getsize(full_path)
+                return fname, checksum, os.path.getsize(full_path)
+        chunks = self.mode == 'http' and self._iter_http(attachment['id']) or self._iter_rpc(attachment['id'])
+        sha, size = hashlib.sha1(), 0
+        with tempfile.NamedTemporaryFile(dir=self.filestore, prefix='.cemig-', delete=False) as tmp:
+            try:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            except Exception:
+                tmp.close()
+                os.unlink(tmp.name)
+                raise
+        with self.lock:
+            self.bytes_downloaded += size
+        if checksum and sha.hexdigest() != checksum:
+            _logger.warning('MIG: ... attachment %s: checksum %s instead of %s' % (
+                attachment['id'], sha.hexdigest(), checksum))
+        checksum = sha.hexdigest()
+        if not size:
+            os.unlink(tmp.name)
+            return False, checksum, 0
+        fname, full_path = filestore_path(self.filestore, checksum)
+        if os.path.isfile(full_path):
+            os.unlink(tmp.name)
+        else:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            os.replace(tmp.name, full_path)
+        return fname, checksum, size
+
+    def download(self, attachments):
+        """Return {remote id: (store_fname, checksum, file_size) or the exception raised}.
+        Attachments sharing a remote checksum are downloaded once.
+        """
+        first = {}
+        for att in attachments:
+            first.setdefault(att.get('checksum') or ('id', att['id']), att)
+
+        def store(att):
+            try:
+                return self._store(att)
+            except Exception as e:
+                return e
+
+        stored = dict(zip(first, self.executor.map(store, first.values())))
+        self.files += len(stored)
+        return {att['id']: stored[att.get('checksum') or ('id', att['id'])] for att in attachments}
+
+    def report(self):
+        seconds = time.monotonic() - self.started
+        _logger.info('MIG: ... attachments: %s files, %.1f MB downloaded at %.2f MB/s, %.1f MB already stored' % (
+            self.files, self.bytes_downloaded / 1e6, seconds and self.bytes_downloaded / 1e6 / seconds,
+            self.bytes_deduplicated / 1e6))
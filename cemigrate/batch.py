@@ -0,0 +1,116 @@
+import time
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class CreateBatch(object):
+    """Collect the vals of the records to create and create them with one multi-create call
+    every time `size` vals are pending. on_create(vals_list, records) is called after each create.
+    """
+
+    def __init__(self, rs, size, on_create=None):
+        self.rs = rs
+        self.size = size
+        self.on_create = on_create
+        self.pending = []
+        self.keys = set()
+
+    def add(self, vals, key=None):
+        """Queue vals for creation. Returns False if a record with the same key is already queued."""
+        if key is not None:
+            if key in self.keys:
+                return False
+            self.keys.add(key)
+        self.pending.append(vals)
+        if len(self.pending) >= self.size:
+            self.flush()
+        return True
+
+    def flush(self):
+        if not self.pending:
+            return self.rs.browse()
+        vals_list = self.pending
+        self.clear()
+        records = self.rs.create(vals_list)
+        _logger.info('MIG: ... created %s %s records' % (len(records), self.rs._name))
+        if self.on_create:
+            self.on_create(vals_list, records)
+        return records
+
+    def clear(self):
+        self.pending = []
+        self.keys = set()
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+class WriteBatch(object):
+    """Collect the vals to write per record id and write each distinct vals once on all its records.
+    Records that end up with the same values, e.g. the same country_id, are updated with one write.
+    """
+
+    def __init__(self, rs, size=None):
+        self.rs = rs
+        self.size = size
+        self.clear()
+
+    def add(self, record_id, vals):
+        key = _freeze(vals)
+        previous = self.record_keys.get(record_id)
+        if previous is not None:
+            # the last vals win, as they would with one write per record
+            self.groups[previous][1].remove(record_id)
+        self.record_keys[record_id] = key
+        self.groups.setdefault(key, (vals, []))[1].append(record_id)
+        if self.size and len(self.record_keys) >= self.size:
+            self.flush()
+
+    def flush(self):
+        groups = self.groups
+        self.clear()
+        for vals, ids in groups.values():
+            if ids:
+                self.rs.browse(ids).write(vals)
+        if groups:
+            _logger.info('MIG: ... %s writes on %s' % (len(groups), self.rs._name))
+
+    def clear(self):
+        self.groups = {}
+        self.record_keys = {}
+
+
+class CommitPolicy(object):
+    """When to commit while importing: every `records` processed records or every `seconds`,
+    whatever comes first. With skip_errors a record that fails on its own is logged and skipped,
+    otherwise the error is raised.
+
+    phases overrides these values for a phase, e.g.
+    CommitPolicy(records=1000, phases={'init_import_models': {'records': 100, 'seconds': 30}})
+    """
+
+    def __init__(self, records=1000, seconds=None, skip_errors=False, phases=None):
+        self.records = records
+        self.seconds = seconds
+        self.skip_errors = skip_errors
+        self.phases = phases or {}
+
+    def for_phase(self, phase):
+        overrides = self.phases.get(phase)
+        if not overrides:
+            return self
+        values = dict(records=self.records, seconds=self.seconds, skip_errors=self.skip_errors)
+        values.update(overrides)
+        return CommitPolicy(**values)
+
+    def is_due(self, count, started):
+        """count records were processed since the last commit, done at time.monotonic() started"""
+        if self.records and count >= self.records:
+            return True
+        return bool(self.seconds) and time.monotonic() - started >= self.seconds
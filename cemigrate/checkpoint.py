@@ -0,0 +1,324 @@
+import os
+import json
+import hashlib
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+
+_logger = logging.getLogger(__name__)
+
+
+class CheckpointStore(object):
+    """Keeps, per model and phase, the highest remote id done and the remote ids that failed.
+    Also keeps the hashes of the remote values last imported, see RowHashes, and the write_date up
+to which the remote records were synced, see Watermark.
+
+    transactional stores write in the target database cursor, so the checkpoint is committed
+    together with the imported records. The others are saved right after each commit.
+    """
+    transactional = False
+
+    def reopen(self, env):
+        """Return a store on the same checkpoints for a forked worker, env being the worker's own environment"""
+        raise NotImplementedError
+
+    def get(self, model_name, phase):
+        """Return (last id, set of failed ids) or None if there is no checkpoint yet"""
+        raise NotImplementedError
+
+    def save(self, model_name, phase, last_id, failed_ids):
+        raise NotImplementedError
+
+    def reset(self, model_name=None, phase=None):
+        """Forget the checkpoints of a model and/or a phase, all of them by default"""
+        raise NotImplementedError
+
+    def get_hashes(self, model_name, fields_key, old_ids):
+        """Return {old id: hash} of the old ids having one"""
+        raise NotImplementedError
+
+    def save_hashes(self, model_name, fields_key, hashes):
+        raise NotImplementedError
+
+    def reset_hashes(self, model_name=None):
+        """Forget the hashes of a model, all of them by default: the next run imports every record again"""
+        raise NotImplementedError
+
+    def get_watermark(self, model_name, phase):
+        """Return the remote write_date synced by the last run of the phase, or None"""
+        raise NotImplementedError
+
+    def save_watermark(self, model_name, phase, write_date):
+        raise NotImplementedError
+
+    def reset_watermarks(self, model_name=None):
+        """Forget the watermarks of a model, all of them by default: the next run is a full one"""
+        raise NotImplementedError
+
+
+class SqliteCheckpointStore(CheckpointStore):
+    """Checkpoints kept in a local SQLite file"""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoint (
+                model TEXT NOT NULL,
+                phase TEXT NOT NULL,
+                last_id INTEGER NOT NULL DEFAULT 0,
+                failed_ids TEXT NOT NULL DEFAULT '[]',
+                PRIMARY KEY (model, phase))""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS row_hash (
+                model TEXT NOT NULL,
+                fields TEXT NOT NULL,
+                old_id INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                PRIMARY KEY (model, fields, old_id))""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS watermark (
+                model TEXT NOT NULL,
+                phase TEXT NOT NULL,
+                write_date TEXT NOT NULL,
+                PRIMARY KEY (model, phase))""")
+        self.db.commit()
+
+    def reopen(self, env):
+        # a connection must not be shared with a forked process
+        return SqliteCheckpointStore(self.path)
+
+    def get(self, model_name, phase):
+        row = self.db.execute('SELECT last_id, failed_ids FROM checkpoint WHERE model = ? AND phase = ?',
+                              (model_name, phase)).fetchone()
+        return row and (row[0], set(json.loads(row[1]))) or None
+
+    def save(self, model_name, phase, last_id, failed_ids):
+        self.db.execute('INSERT OR REPLACE INTO checkpoint (model, phase, last_id, failed_ids) VALUES (?, ?, ?, ?)',
+                        (model_name, phase, last_id, json.dumps(sorted(failed_ids))))
+        self.db.commit()
+
+    def reset(self, model_name=None, phase=None):
+        self.db.execute('DELETE FROM checkpoint WHERE (? IS NULL OR model = ?) AND (? IS NULL OR phase = ?)',
+                        (model_name, model_name, phase, phase))
+        self.db.commit()
+
+    def get_hashes(self, model_name, fields_key, old_ids):
+        old_ids = list(old_ids)
+        res = {}
+        # stay under the limit of host parameters of old SQLite versions
+        for start in range(0, len(old_ids), 900):
+            chunk = old_ids[start:start + 900]
+            res.update(self.db.execute(
+                'SELECT old_id, hash FROM row_hash WHERE model = ? AND fields = ? AND old_id IN (%s)' % (
+                    ', '.join('?' * len(chunk))), [model_name, fields_key] + chunk))
+        return res
+
+    def save_hashes(self, model_name, fields_key, hashes):
+        self.db.executemany('INSERT OR REPLACE INTO row_hash (model, fields, old_id, hash) VALUES (?, ?, ?, ?)',
+                            [(model_name, fields_key, old_id, value) for old_id, value in hashes.items()])
+        self.db.commit()
+
+    def reset_hashes(self, model_name=None):
+        self.db.execute('DELETE FROM row_hash WHERE ? IS NULL OR model = ?', (model_name, model_name))
+        self.db.commit()
+
+    def get_watermark(self, model_name, phase):
+        row = self.db.execute('SELECT write_date FROM watermark WHERE model = ? AND phase = ?',
+                              (model_name, phase)).fetchone()
+        return row and row[0] or None
+
+    def save_watermark(self, model_name, phase, write_date):
+        self.db.execute('INSERT OR REPLACE INTO watermark (model, phase, write_date) VALUES (?, ?, ?)',
+                        (model_name, phase, write_date))
+        self.db.commit()
+
+    def reset_watermarks(self, model_name=None):
+        self.db.execute('DELETE FROM watermark WHERE ? IS NULL OR model = ?', (model_name, model_name))
+        self.db.commit()
+
+
+class DbCheckpointStore(CheckpointStore):
+    """Checkpoints kept in the cemigrate_checkpoint table of the target database"""
+    transactional = True
+
+    def __init__(self, env):
+        self.env = env
+        self.env.cr.execute("""
+            CREATE TABLE IF NOT EXISTS cemigrate_checkpoint (
+                model VARCHAR NOT NULL,
+                phase VARCHAR NOT NULL,
+                last_id INTEGER NOT NULL DEFAULT 0,
+                failed_ids INTEGER[] NOT NULL DEFAULT '{}',
+                PRIMARY KEY (model, phase))""")
+        self.env.cr.execute("""
+            CREATE TABLE IF NOT EXISTS cemigrate_row_hash (
+                model VARCHAR NOT NULL,
+                fields VARCHAR NOT NULL,
+                old_id INTEGER NOT NULL,
+                hash VARCHAR NOT NULL,
+                PRIMARY KEY (model, fields, old_id))""")
+        self.env.cr.execute("""
+            CREATE TABLE IF NOT EXISTS cemigrate_watermark (
+                model VARCHAR NOT NULL,
+                phase VARCHAR NOT NULL,
+                write_date VARCHAR NOT NULL,
+                PRIMARY KEY (model, phase))""")
+
+    def reopen(self, env):
+        return DbCheckpointStore(env)
+
+    def get(self, model_name, phase):
+        self.env.cr.execute('SELECT last_id, failed_ids FROM cemigrate_checkpoint WHERE model = %s AND phase = %s',
+                            [model_name, phase])
+        row = self.env.cr.fetchone()
+        return row and (row[0], set(row[1])) or None
+
+    def save(self, model_name, phase, last_id, failed_ids):
+        self.env.cr.execute("""
+            INSERT INTO cemigrate_checkpoint (model, phase, last_id, failed_ids) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (model, phase) DO UPDATE SET last_id = EXCLUDED.last_id, failed_ids = EXCLUDED.failed_ids
+        """, [model_name, phase, last_id, sorted(failed_ids)])
+
+    def reset(self, model_name=None, phase=None):
+        self.env.cr.execute("""
+            DELETE FROM cemigrate_checkpoint
+            WHERE (%(model)s IS NULL OR model = %(model)s) AND (%(phase)s IS NULL OR phase = %(phase)s)
+        """, {'model': model_name, 'phase': phase})
+
+    def get_hashes(self, model_name, fields_key, old_ids):
+        self.env.cr.execute(
+            'SELECT old_id, hash FROM cemigrate_row_hash WHERE model = %s AND fields = %s AND old_id = ANY(%s)',
+            [model_name, fields_key, list(old_ids)])
+        return dict(self.env.cr.fetchall())
+
+    def save_hashes(self, model_name, fields_key, hashes):
+        if not hashes:
+            return
+        values = ', '.join(['%s'] * len(hashes))
+        self.env.cr.execute("""
+            INSERT INTO cemigrate_row_hash (model, fields, old_id, hash) VALUES %s
+            ON CONFLICT (model, fields, old_id) DO UPDATE SET hash = EXCLUDED.hash
+        """ % values, [(model_name, fields_key, old_id, value) for old_id, value in hashes.items()])
+
+    def reset_hashes(self, model_name=None):
+        self.env.cr.execute('DELETE FROM cemigrate_row_hash WHERE %(model)s IS NULL OR model = %(model)s',
+                            {'model': model_name})
+
+    def get_watermark(self, model_name, phase):
+        self.env.cr.execute('SELECT write_date FROM cemigrate_watermark WHERE model = %s AND phase = %s',
+                            [model_name, phase])
+        row = self.env.cr.fetchone()
+        return row and row[0] or None
+
+    def save_watermark(self, model_name, phase, write_date):
+        self.env.cr.execute("""
+            INSERT INTO cemigrate_watermark (model, phase, write_date) VALUES (%s, %s, %s)
+            ON CONFLICT (model, phase) DO UPDATE SET write_date = EXCLUDED.write_date
+        """, [model_name, phase, write_date])
+
+    def reset_watermarks(self, model_name=None):
+        self.env.cr.execute('DELETE FROM cemigrate_watermark WHERE %(model)s IS NULL OR model = %(model)s',
+                            {'model': model_name})
+
+
+class Checkpoint(object):
+    """Progress of one model and phase in a CheckpointStore"""
+
+    def __init__(self, store, model_name, phase):
+        self.store = store
+        self.model_name = model_name
+        self.phase = phase
+        state = store.get(model_name, phase)
+        self.exists = state is not None
+        self.last_id, self.failed_ids = state or (0, set())
+
+    def domain(self):
+        """Domain of the remote records left: after the last id done, plus the ones that failed"""
+        if self.failed_ids:
+            return ['|', ('id', '>', self.last_id), ('id', 'in', sorted(self.failed_ids))]
+        return [('id', '>', self.last_id)]
+
+    def next_state(self, done_ids=(), failed_ids=()):
+        last_id = max([self.last_id] + list(done_ids) + list(failed_ids))
+        return last_id, (self.failed_ids - set(done_ids)) | set(failed_ids)
+
+    def save(self, state):
+        self.store.save(self.model_name, self.phase, *state)
+
+    def apply(self, state):
+        self.last_id, self.failed_ids = state
+        self.exists = True
+
+
+class RowHashes(object):
+    """Hashes of the remote values imported per record of a model, for a set of fields.
+
+    changed(rec) tells whether the values of rec differ from the ones last imported. The new hashes
+    are saved with the commit of the records, like a Checkpoint: give it to the batched runner.
+    """
+
+    def __init__(self, store, model_name, fields):
+        self.store = store
+        self.model_name = model_name
+        self.fields = sorted(set(fields) - {'id'})
+        self.fields_key = hashlib.sha1(','.join(self.fields).encode()).hexdigest()
+        # hashes of the records loaded with load()
+        self.known = {}
+        # {old id: hash} to save once the record is committed
+        self.pending = {}
+
+    def hash(self, rec):
+        values = [(field_name, rec.get(field_name)) for field_name in self.fields]
+        return hashlib.blake2b(repr(values).encode(), digest_size=16).hexdigest()
+
+    def load(self, old_ids):
+        """Fetch the hashes of a page of records"""
+        self.known = self.store.get_hashes(self.model_name, self.fields_key, old_ids)
+
+    def changed(self, rec):
+        value = self.hash(rec)
+        if self.known.get(rec['id']) == value:
+            return False
+        self.pending[rec['id']] = value
+        return True
+
+    def next_state(self, done_ids=(), failed_ids=()):
+        return {old_id: self.pending[old_id] for old_id in done_ids if old_id in self.pending}
+
+    def save(self, state):
+        self.store.save_hashes(self.model_name, self.fields_key, state)
+
+    def apply(self, state):
+        for old_id in state:
+            self.pending.pop(old_id, None)
+
+
+class Watermark(object):
+    """The remote write_date up to which a phase synced a model.
+
+    `start` is the latest remote write_date when the phase starts: saved once the phase is done, the
+    next run only reads the records written after it, minus `overlap` seconds for the transactions that
+    were not committed yet on the remote server.
+    """
+    DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, store, model_name, phase, start, overlap=60):
+        self.store = store
+        self.model_name = model_name
+        self.phase = phase
+        self.start = start
+        self.overlap = overlap
+        self.value = store.get_watermark(model_name, phase)
+
+    def domain(self):
+        """Domain of the remote records written since the last run, [] the first time"""
+        if not self.value:
+            return []
+        since = datetime.strptime(self.value[:19], self.DATE_FORMAT) - timedelta(seconds=self.overlap)
+        return [('write_date', '>', since.strftime(self.DATE_FORMAT))]
+
+    def save(self):
+        if self.start:
+            self.store.save_watermark(self.model_name, self.phase, self.start)
+            self.value = self.start
@@ -0,0 +1,170 @@
+import logging
+import itertools
+from datetime import date, datetime
+
+_logger = logging.getLogger(__name__)
+
+# types compared in python exactly like the database compares them with '='
+MATCHABLE_TYPES = ('char', 'text', 'selection', 'integer', 'boolean', 'many2one', 'date', 'datetime')
+
+
+def _normalize(value):
+    """Local value as the remote records give it"""
+    if value is None:
+        return False
+    if isinstance(value, (list, tuple)) and len(value) == 2:
+        # many2one read as (id, display name)
+        return value[0]
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    return value
+
+
+class KeyMatcher(object):
+    """Local records matching the key fields of the remote records, loaded a page at a time.
+
+    prime() searches with one query the local records matching all the keys of a page and indexes
+    them by key, match() then answers from the index. A key that was not primed is searched alone.
+    Keys are (key fields, values) pairs, values as _handle_record builds them.
+    """
+
+    def __init__(self, rs, old_id_field, archived=False):
+        self.rs = rs
+        self.old_id_field = old_id_field
+        self.archived = archived
+        # {(key fields, values): [(local id, old id)]}
+        self.index = {}
+        # {old id: key} of the records queued in a CreateBatch
+        self.queued = {}
+        # keys changed since the last commit
+        self.touched = set()
+        # {old id: local ids} of the remote records matching several local records
+        self.ambiguous = {}
+        # old ids of the remote records without local record, not created
+        self.missing = set()
+        # {remote id: what the caller prepared while priming the record}, see keep and take
+        self.prepared = {}
+        # prepared values taken since the last commit, given back on rollback
+        self.taken = {}
+
+    def supports(self, key_fields):
+        fields = self.rs._fields
+        return all(f in fields and fields[f].type in MATCHABLE_TYPES for f in key_fields)
+
+    def commit(self):
+        self.touched = set()
+        self.taken = {}
+
+    def rollback(self):
+        """Forget the keys changed since the last commit, they may hold records that don't exist anymore.
+        The prepared values taken since then are kept for the records processed again.
+        """
+        for key in self.touched:
+            self.index.pop(key, None)
+        self.touched = set()
+        self.queued = {}
+        self.prepared.update(self.taken)
+        self.taken = {}
+
+    def keep(self, remote_id, value):
+        self.prepared[remote_id] = value
+
+    def take(self, remote_id):
+        """Return the value kept for remote_id while priming, None if there is none"""
+        value = self.prepared.pop(remote_id, None)
+        if value is not None:
+            self.taken[remote_id] = value
+        return value
+
+    def _domain(self, key_fields, keys):
+        domain = []
+        if 'active' in key_fields or self.archived:
+            domain = ['|', ('active', '=', False), ('active', '=', True)]
+        for position, field_name in enumerate(key_fields):
+            values = {key[position] for key in keys}
+            leaves = []
+            present = [value for value in values if value is not False and value is not None]
+            if present:
+                leaves.append((field_name, 'in', present))
+            if len(present) < len(values):
+                leaves.append((field_name, '=', False))
+            domain.extend(len(leaves) > 1 and ['|'] + leaves or leaves)
+        return domain
+
+    def prime(self, keys):
+        """Load the local records matching keys, one search per set of key fields"""
+        by_fields = {}
+        for key_fields, values in keys:
+            if (key_fields, values) not in self.index and self.supports(key_fields):
+                by_fields.setdefault(key_fields, set()).add(values)
+        for key_fields, values_set in by_fields.items():
+            for values in values_set:
+                self.index[(key_fields, values)] = []
+            found = 0
+            for rec in self.rs.search_read(self._domain(key_fields, values_set),
+                                           list(key_fields) + [self.old_id_field]):
+                candidates = self.index.get((key_fields, tuple(_normalize(rec[f]) for f in key_fields)))
+                if candidates is not None:
+                    candidates.append((rec['id'], rec[self.old_id_field]))
+                    found += 1
+            _logger.info('MIG: ... %s: %s keys, %s local records found' % (self.rs._name, len(values_set), found))
+
+    def iter_primed(self, records, key_of, size):
+        """Yield records, priming the keys of each page of `size` records before the first is yielded.
+        key_of(record) returns its key, it may change the record it gets. A record whose key can't be computed
+        is not primed: the error is raised again when it's processed, where the errors of records are handled.
+        """
+        records = iter(records)
+        while True:
+            page = list(itertools.islice(records, size))
+            if not page:
+                return
+            keys = []
+            for rec in page:
+                try:
+                    keys.append(key_of(dict(rec)))
+                except Exception as e:
+                    _logger.debug('MIG: ... %s: no key for record %s: %s' % (self.rs._name, rec.get('id'), e))
+            self.prime(keys)
+            yield from page
+
+    def match(self, key_fields, values):
+        """[(local id, old id)] of the local records matching the key"""
+        key = (tuple(key_fields), tuple(values))
+        if key not in self.index:
+            self.prime([key])
+        return self.index[key]
+
+    def add(self, key_fields, values, local_id, old_id):
+        key = (tuple(key_fields), tuple(values))
+        self.index.setdefault(key, []).append((local_id, old_id))
+        self.touched.add(key)
+
+    def set_old_id(self, key_fields, values, local_id, old_id):
+        key = (tuple(key_fields), tuple(values))
+        self.index[key] = [(local_id, old_id)]
+        self.touched.add(key)
+
+    def queue(self, key_fields, values, old_id):
+        self.queued[old_id] = (tuple(key_fields), tuple(values))
+
+    def created(self, vals_list, records):
+        """on_create of the CreateBatch: index the records created from queued keys"""
+        for vals, record in zip(vals_list, records):
+            key = self.queued.pop(vals.get(self.old_id_field), None)
+            if key:
+                self.index[key] = [(record.id, vals[self.old_id_field])]
+                self.touched.add(key)
+
+    def report(self):
+        """Log the remote records that matched several local records or none"""
+        if self.ambiguous:
+            _logger.warning('MIG: ... %s: %s records match several local records, e.g. %s' % (
+                self.rs._name, len(self.ambiguous), ', '.join(
+                    'old id %s: %s' % (old_id, local_ids)
+                    for old_id, local_ids in itertools.islice(sorted(self.ambiguous.items()), 10))))
+        if self.missing:
+            _logger.warning('MIG: ... %s: %s records have no local record and are not created, e.g. old ids %s' % (
+                self.rs._name, len(self.missing), sorted(self.missing)[:10]))
@@ -0,0 +1,44 @@
+import os
+import json
+import hashlib
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def remote_fingerprint(connection):
+    """Hash of the modules installed on the remote server and their versions"""
+    modules = connection.get_model('ir.module.module').search_read(
+        [('state', '=', 'installed')], ['name', 'latest_version'])
+    versions = sorted((m['name'], m['latest_version'] or '') for m in modules)
+    return hashlib.sha1(repr(versions).encode()).hexdigest()
+
+
+class FieldsCache(object):
+    """Fields of the origin models saved in a json file so following runs don't fetch them again.
+
+    The file holds one entry per key, built from the remote database name and the fingerprint of
+    its installed modules: upgrading a module on the old server invalidates the cache.
+    """
+
+    def __init__(self, path, key):
+        self.path = os.path.expanduser(path)
+        self.key = key
+        self.data = {}
+        if os.path.exists(self.path):
+            with open(self.path) as cache_file:
+                self.data = json.load(cache_file)
+
+    @classmethod
+    def for_connection(cls, path, connection):
+        return cls(path, '%s:%s' % (connection.database, remote_fingerprint(connection)))
+
+    def get(self, model_name):
+        return self.data.get(self.key, {}).get(model_name)
+
+    def set(self, model_name, fields):
+        self.data.setdefault(self.key, {})[model_name] = fields
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(self.data, cache_file)
+        os.replace(tmp_path, self.path)
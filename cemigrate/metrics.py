@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import atexit
+import logging
+from contextlib import nullcontext
+
+_logger = logging.getLogger(__name__)
+
+# seconds spent per kind of work
+KINDS = ('rpc', 'orm', 'commit')
+# stats of the workers merged as the maximum, the others are added
+MAX_STATS = ('wall_seconds', 'max_commit_records')
+
+
+class _Timer(object):
+    __slots__ = ('stats', 'key', 'started')
+
+    def __init__(self, stats, key):
+        self.stats = stats
+        self.key = key
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.stats[self.key] += time.perf_counter() - self.started
+
+
+class Metrics(object):
+    """Timers and counters per model and phase of a run.
+
+    For each (model, phase): seconds spent reading the old server (rpc), in the local ORM (orm) and
+    committing (commit), the wall time, the records done, the errors, the commits and the biggest
+    commit. Exported as json, or as Prometheus text when path ends with .prom, every `interval`
+    seconds if set and at the end of the run.
+    """
+
+    def __init__(self, path=None, interval=None):
+        self.path = path and os.path.expanduser(path)
+        self.interval = interval
+        self.stats = {}
+        self.exported = time.monotonic()
+        if self.path:
+            atexit.register(self.export)
+
+    def _stats(self, model_name, phase):
+        stats = self.stats.get((model_name, phase))
+        if stats is None:
+            stats = self.stats[(model_name, phase)] = dict.fromkeys(
+                ['%s_seconds' % kind for kind in KINDS] +
+                ['wall_seconds', 'records', 'errors', 'commits', 'max_commit_records'], 0)
+        return stats
+
+    def timer(self, model_name, phase, kind):
+        """Context manager adding the time spent to the seconds of kind"""
+        return _Timer(self._stats(model_name, phase), '%s_seconds' % kind)
+
+    def timed(self, function, model_name, phase, kind):
+        """Return function, adding the time spent in each call to the seconds of kind"""
+        timer = self.timer(model_name, phase, kind)
+
+        def wrapper(*args, **kwargs):
+            with timer:
+                return function(*args, **kwargs)
+        return wrapper
+
+    def count(self, model_name, phase, name, value=1):
+        """Add value to the counter name, e.g. errors or bytes_downloaded"""
+        stats = self._stats(model_name, phase)
+        stats[name] = stats.get(name, 0) + value
+
+    def for_worker(self):
+        """Empty Metrics for a forked worker, never exported: its stats are given to merge()"""
+        return Metrics()
+
+    def merge(self, stats):
+        """Add the stats of a worker. The workers run side by side, their wall time is the longest one."""
+        for (model_name, phase), worker_stats in stats.items():
+            own = self._stats(model_name, phase)
+            for name, value in worker_stats.items():
+                if name in MAX_STATS:
+                    own[name] = max(own.get(name, 0), value)
+                else:
+                    own[name] = own.get(name, 0) + value
+
+    def committed(self, model_name, phase, records):
+        stats = self._stats(model_name, phase)
+        stats['commits'] += 1
+        stats['records'] += records
+        stats['max_commit_records'] = max(stats['max_commit_records'], records)
+        if self.interval and time.monotonic() - self.exported >= self.interval:
+            self.export()
+
+    def as_dict(self):
+        res = {}
+        for (model_name, phase), stats in self.stats.items():
+            stats = dict(stats)
+            stats['records_per_second'] = stats['wall_seconds'] and round(stats['records'] / stats['wall_seconds'], 2)
+            res.setdefault(model_name, {})[phase] = stats
+        return res
+
+    def to_prometheus(self):
+        lines = []
+        for model_name, phases in sorted(self.as_dict().items()):
+            for phase, stats in sorted(phases.items()):
+                for name, value in sorted(stats.items()):
+                    lines.append('cemigrate_%s{model="%s",phase="%s"} %s' % (name, model_name, phase, value))
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        self.exported = time.monotonic()
+        if not self.path:
+            return
+        if self.path.endswith('.prom'):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.as_dict(), indent=2, sort_keys=True)
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(content)
+        os.replace(tmp_path, self.path)
+
+
+class NoMetrics(object):
+    """Metrics turned off: every hook does nothing"""
+    _timer = nullcontext()
+    # nothing is ever added
+    stats = {}
+
+    def timer(self, model_name, phase, kind):
+        return self._timer
+
+    def timed(self, function, model_name, phase, kind):
+        return function
+
+    def count(self, model_name, phase, name, value=1):
+        pass
+
+    def for_worker(self):
+        return self
+
+    def merge(self, stats):
+        pass
+
+    def committed(self, model_name, phase, records):
+        pass
+
+    def export(self):
+        pass
@@ -1,8 +1,20 @@
 import os
 import ast
 import inspect
+import time
 import logging
+from types import MappingProxyType
 from odoolib.main import JsonRPCException
+from .batch import CreateBatch, WriteBatch, CommitPolicy
+from .metadata import FieldsCache
+from .checkpoint import Checkpoint, RowHashes, Watermark
+from .metrics import Metrics, NoMetrics
+from .prefetch import PrefetchPipeline
+from .partition import run_partitioned, advisory_lock
+from .snapshot import SnapshotConnection
+from .matching import KeyMatcher
+from .sqlbatch import SqlCreateBatch, SqlWriteBatch
+from .attachments import AttachmentDownloader
 
 _logger = logging.getLogger(__name__)
 
@@ -20,8 +32,24 @@ class MigrationError(Exception):
     pass
 
 
+# help of the x_<model>_id fields, finalize finds them with it
+OLD_ID_HELP = 'Technical field used for migration'
+
+# yielded among the records given to _run_batched: the batches are flushed before the next record is asked for
+FLUSH_BATCHES = object()
+
+
+def index_name(table, column, suffix):
+    """Name of an index created by cemigrate, cut to 63 characters as PostgreSQL does"""
+    return ('%s_%s_%s' % (table, column, suffix))[:63]
+
+
+def old_id_field(model_name):
+    return 'x_%s_id' % model_name.replace('.', '_')
+
+
 def rename_id(record, model_name):
-    record['x_%s_id' % model_name.replace('.', '_')] = record['id']
+    record[old_id_field(model_name)] = record['id']
     del record['id']
     return record
 
@@ -33,20 +61,111 @@ def get_first_from_id(record):
     return record
 
 
+def parse_domain(domain):
+    """Domain of a field as stored in ir.model.fields, [] when it depends on the record or the context"""
+    try:
+        return list(ast.literal_eval(domain or '[]'))
+    except (ValueError, SyntaxError):
+        _logger.warning('MIG: ... ignoring the domain %s' % domain)
+        return []
+
+
 def rec_to_str(rec):
     return "%s" % rec.get('name', rec.get('id'))
 
 
+class ModelIndex(object):
+    """Lookups compiled once from the CEMIG_CONFIG models: old -> new model, new -> old model
+    and the name of the x_<model>_id field of each old model.
+
+    When several old models are migrated to the same new model the reverse lookup is ambiguous,
+    flag one of them with 'primary': True in the config to choose it.
+    """
+
+    def __init__(self, model_info):
+        self.new_models = MappingProxyType({k: v['new_model_name'] for k, v in model_info.items()})
+        self.old_id_fields = MappingProxyType({k: old_id_field(k) for k in model_info})
+        candidates = {}
+        for old_model, info in model_info.items():
+            candidates.setdefault(info['new_model_name'], []).append(old_model)
+        old_models, ambiguous = {}, {}
+        for new_model, olds in candidates.items():
+            primary = [m for m in olds if model_info[m].get('primary')]
+            if len(olds) == 1 or len(primary) == 1:
+                old_models[new_model] = primary and primary[0] or olds[0]
+            else:
+                ambiguous[new_model] = tuple(sorted(olds))
+                _logger.warning('MIG: %s are all migrated to %s, set primary on one of them to resolve %s '
+                                'relations' % (', '.join(ambiguous[new_model]), new_model, new_model))
+        self.old_models = MappingProxyType(old_models)
+        self.ambiguous = MappingProxyType(ambiguous)
+
+    def new_model(self, old_model):
+        return self.new_models[old_model]
+
+    def old_id_field(self, old_model):
+        """Name of the x_<model>_id field, also for the models outside the config like mail.message"""
+        return self.old_id_fields.get(old_model) or old_id_field(old_model)
+
+    def old_model(self, new_model):
+        """Return the old model migrated to new_model, '' if there is none"""
+        if new_model in self.ambiguous:
+            raise MigrationError('Ambiguous model mapping: %s are all migrated to %s' % (
+                ', '.join(self.ambiguous[new_model]), new_model))
+        return self.old_models.get(new_model, '')
+
+
 class MigrateToolBase(object):
     MODEL_INFO: dict
+    model_index: ModelIndex
+    # default number of records fetched per remote search_read, override per model with 'page_size'
+    PAGE_SIZE = 1000
+    # seconds read again before the watermark of incremental runs, override per model with 'incremental_overlap'
+    INCREMENTAL_OVERLAP = 60
 
-    def __init__(self, env, connection, verbose=False, test_mode=False):
+    def __init__(self, env, connection, verbose=False, test_mode=False, commit_policy=None,
+                 metadata_cache_path=None, checkpoint_store=None, prefetch_workers=None, prefetch_depth=None,
+                 incremental=False, metrics=None, snapshot_path=None, snapshot_refresh=None):
         self.env = env
+        # replay what previous runs fetched from the old server, see SnapshotConnection
+        snapshot_path = snapshot_path or os.environ.get('CEMIG_SNAPSHOT')
+        if snapshot_path:
+            connection = SnapshotConnection(connection, snapshot_path,
+                                            snapshot_refresh or os.environ.get('CEMIG_SNAPSHOT_REFRESH') or None)
         self.connection = connection
         self.model_name = 'res.partner'
         self.MODEL_INFO = {}
         self.verbose = verbose
         self.test_mode = test_mode
+        self.commit_policy = commit_policy or CommitPolicy()
+        self.checkpoint_store = checkpoint_store
+        # only read the remote records written since the last run, needs a checkpoint store
+        self.incremental = incremental
+        metrics_path = os.environ.get('CEMIG_METRICS')
+        self.metrics = metrics or (metrics_path and Metrics(metrics_path, interval=60)) or NoMetrics()
+        # rpc timer of the phase run by _run_batched, around the reads of remote_iter_pages
+        self._rpc_timer = NoMetrics._timer
+        # {old model name: {old id: new id}}, see get_id_map
+        self._id_maps = {}
+        # (model name, old id, previous new id) registered since the last commit, undone on rollback
+        self._id_map_log = []
+        # {old model name: field metadata}, see get_model_metadata
+        self._model_metadata = {}
+        metadata_cache_path = metadata_cache_path or os.environ.get('CEMIG_METADATA_CACHE')
+        self.fields_cache = metadata_cache_path and FieldsCache.for_connection(metadata_cache_path, connection)
+        # threads reading the remote pages ahead of the import, 0 reads them in the main thread
+        self.prefetch_workers = int(prefetch_workers or os.environ.get('CEMIG_PREFETCH_WORKERS') or 0)
+        self.prefetch_depth = prefetch_depth or 2 * self.prefetch_workers
+        # {workers: PrefetchPipeline}, kept with their threads and connections for the whole run
+        self._prefetch = {}
+        # (first id, last id) of the remote records handled by this process when partitioned
+        self.partition = None
+        # called with (phase, done ids, failed ids) after each commit of the batched runner
+        self.progress_callback = None
+        # {old model name: KeyMatcher} of the running init_import_models, see _handle_record
+        self._key_matchers = {}
+        # old model names whose id map holds remote ids mapped to a record imported from another one
+        self._aliased = set()
         model_methods = dir(self)
         self.post_methods = {key.replace('post_', '').replace('_', '.'): key for key in
                              filter(lambda m: m.startswith('post_'), model_methods)}
@@ -55,61 +174,133 @@ class MigrateToolBase(object):
         self._recalc_model()
 
     def ensure_old_id(self, model_name, new_model_name):
+        """Create the x_<model>_id field and index it.
+        The 'old_id_index' of the model config chooses the index: True (default) for the btree index
+        Odoo builds for an indexed field, 'unique' for a unique index on the rows having an old id
+        instead, False for none.
+        """
         model = self.env['ir.model'].search([('model', '=', new_model_name)])
         has_old_id = self.env['ir.model.fields'].search([
-            ('name', '=', 'x_%s_id' % model_name.replace('.', '_')),
+            ('name', '=', self._old_id_field(model_name)),
             ('model_id', '=', model.id)
         ])
+        index = self.MODEL_INFO.get(model_name, {}).get('old_id_index', True)
+        # the unique index is enough, Odoo must not add its own
+        field_index = bool(index) and index != 'unique'
         if not has_old_id:
             data = {
-                'name': 'x_%s_id' % model_name.replace('.', '_'),
+                'name': self._old_id_field(model_name),
                 'field_description': 'Old %s ID' % model_name,
                 'ttype': 'integer',
-                'help': 'Technical field used for migration',
+                'help': OLD_ID_HELP,
                 'required': False,
                 'store': True,
-                'index': False,
+                'index': field_index,
                 'copied': False,
                 'related': False,
                 'depends': False,
             }
             model.write({'field_id': [(0, 0, data), ]})
             self.env.cr.commit()
+        elif bool(has_old_id.index) != field_index:
+            has_old_id.index = field_index
+            self.env.cr.commit()
+        if index == 'unique':
+            self._create_old_id_unique_index(model_name, new_model_name)
+
+    def _create_old_id_unique_index(self, model_name, new_model_name):
+        table, column = self.env[new_model_name]._table, self._old_id_field(model_name)
+        name = index_name(table, column, 'uniq')
+        self.env.cr.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', [name])
+        if self.env.cr.fetchone():
+            return
+        _logger.info('MIG: ... creating index %s' % name)
+        self.env.cr.execute('CREATE UNIQUE INDEX "%s" ON "%s" ("%s") WHERE "%s" > 0' % (name, table, column, column))
+        self.env.cr.commit()
+
+    def finalize(self, model_names=None, drop_columns=False):
+        """Run once the migration is over: drop the indexes of the x_<model>_id fields and, with
+        drop_columns, the fields themselves.
+
+        :param model_names: new model names, all the models having old id fields by default
+        """
+        domain = [('help', '=', OLD_ID_HELP), ('state', '=', 'manual')]
+        if model_names:
+            domain.append(('model', 'in', list(model_names)))
+        for field in self.env['ir.model.fields'].search(domain):
+            # Odoo drops the btree index of the field itself
+            table = self.env[field.model]._table
+            self.env.cr.execute('DROP INDEX IF EXISTS "%s"' % index_name(table, field.name, 'uniq'))
+            if drop_columns:
+                _logger.info('MIG: ... dropping %s.%s' % (field.model, field.name))
+                field.unlink()
+            elif field.index:
+                field.index = False
+        self.env.cr.commit()
+        self.invalidate_id_maps()
+        self._model_metadata.clear()
 
     def _recalc_model(self):
+        meta = self.get_model_metadata(self.model_name)
+        self.origin_fields = meta['origin_fields']
+        self.new_model_name = meta['new_model_name']
+        self.target_fields = meta['target_fields']
+        self.diff = meta['diff']
+        self.matching_fields = meta['matching_fields']
+        self.matching_char_fields = meta['matching_char_fields']
+        self.matching_many2one_fields = meta['matching_many2one_fields']
+        _logger.info('MIG: ............ origin model: %s to target model: %s ' % (self.model_name, self.new_model_name))
+
+    def get_model_metadata(self, model_name):
+        """Return the fields of the origin and target models and how they match.
+        Computed once per run, the origin fields can also be kept on disk with metadata_cache_path.
+        """
+        meta = self._model_metadata.get(model_name)
+        if meta is None:
+            meta = self._model_metadata[model_name] = self._compute_model_metadata(model_name)
+        return meta
+
+    def _compute_model_metadata(self, model_name):
         # from remote server
-        self.origin_fields = self._get_origin_model_fields(self.model_name)
+        origin_fields = self.fields_cache and self.fields_cache.get(model_name)
+        if origin_fields is None:
+            origin_fields = self._get_origin_model_fields(model_name)
+            if self.fields_cache:
+                self.fields_cache.set(model_name, origin_fields)
         # from this server >= v16
-        self.new_model_name = self._get_field_info_dict(self.model_name)['new_model_name']
-        self.target_fields = self._get_local_model_fields(self.new_model_name)
-        self.ensure_old_id(self.model_name, self.new_model_name)
+        new_model_name = self._get_new_model(model_name)
+        target_fields = self._get_local_model_fields(new_model_name)
+        self.ensure_old_id(model_name, new_model_name)
         # calculate diff
-        self.diff = self._compare_lists(self.origin_fields, self.target_fields, verbose=False)
-        self.matching_fields = filter(lambda x: self.diff[x]['origin'] and self.diff[x]['target'],
-                                      self.origin_fields.keys())
-        _logger.info('MIG: ............ origin model: %s to target model: %s ' % (self.model_name, self.new_model_name))
-        self.matching_char_fields = [
-            field_name for field_name in filter(
-                lambda x: self.diff[x]['origin'] == 'char' and self.diff[x]['target'] in (
-                    'char', 'text', 'boolean', 'selection', 'date', 'datetime'),
-                self.origin_fields.keys())
-        ]
-        self.matching_many2one_fields = [
-            (field_name, self.target_fields[field_name]['relation']) for field_name in filter(
-                lambda x: self.diff[x]['origin'] == 'many2one' and
-                          self.diff[x]['target'] == 'many2one' and
-                          'relation' in self.target_fields[x],
-                self.target_fields.keys())
-        ]
+        diff = self._compare_lists(origin_fields, target_fields, verbose=False)
+        return {
+            'origin_fields': origin_fields,
+            'new_model_name': new_model_name,
+            'target_fields': target_fields,
+            'diff': diff,
+            'matching_fields': [x for x in origin_fields if diff[x]['origin'] and diff[x]['target']],
+            'matching_char_fields': [
+                field_name for field_name in filter(
+                    lambda x: diff[x]['origin'] == 'char' and diff[x]['target'] in (
+                        'char', 'text', 'boolean', 'selection', 'date', 'datetime'),
+                    origin_fields.keys())
+            ],
+            'matching_many2one_fields': [
+                (field_name, target_fields[field_name]['relation']) for field_name in filter(
+                    lambda x: diff[x]['origin'] == 'many2one' and
+                              diff[x]['target'] == 'many2one' and
+                              'relation' in target_fields[x],
+                    target_fields.keys())
+            ],
+        }
 
     def set_param(self, key, value):
         self.env['ir.config_parameter'].sudo().set_param(key, value)
 
     def iprint(self, *args, verbose=False):
-        cur_frame = inspect.currentframe()
-        cal_frame = inspect.getouterframes(cur_frame, 2)
-        caller_name = cal_frame[1][3]
         if verbose or self.verbose:
+            # only look at the caller when printing, it is slow
+            caller_name = inspect.currentframe().f_back.f_code.co_name
             print("\x1b[1m[%s]:\x1b(B\x1b[m " % caller_name, *args)
 
     def _compare_lists(self, origin, target, verbose=False):
@@ -146,10 +337,11 @@ class MigrateToolBase(object):
                     res[key]['extra_args']['post_run'] = self.post_methods[key]
                 if key in self.transform_methods:
                     res[key]['extra_args']['transform'] = self.transform_methods[key]
-            self.MODEL_INFO = res
-            return res
         except Exception:
             raise MigrationError('You need to define CEMIG_CONFIG environment variable')
+        self.model_index = ModelIndex(res)
+        self.MODEL_INFO = res
+        return res
 
     def _get_field_info_dict(self, model_name) -> dict:
         if not self.MODEL_INFO:
@@ -164,17 +356,31 @@ class MigrateToolBase(object):
     def _get_old_model(self, new_model):
         if not self.MODEL_INFO:
             self._get_model_info_dict()
-        return "".join({k: v for k, v in self.MODEL_INFO.items() if v['new_model_name'] == new_model})
+        return self.model_index.old_model(new_model)
+
+    def _get_new_model(self, old_model):
+        if not self.MODEL_INFO:
+            self._get_model_info_dict()
+        return self.model_index.new_model(old_model)
+
+    def _old_id_field(self, old_model):
+        if not self.MODEL_INFO:
+            self._get_model_info_dict()
+        return self.model_index.old_id_field(old_model)
 
     def _get_local_model_fields(self, model_name):
-        return {f['name']: {'type': f['ttype'], 'relation': f['relation']} for f in
+        return {f['name']: {'type': f['ttype'], 'relation': f['relation'], 'relation_field': f['relation_field'],
+                            'domain': f['domain']} for f in
                 self.env['ir.model.fields'].search_read(
-                    [('model', '=', model_name), ('name', '!=', '__last_update')], ['name', 'ttype', 'relation'])}
+                    [('model', '=', model_name), ('name', '!=', '__last_update')],
+                    ['name', 'ttype', 'relation', 'relation_field', 'domain'])}
 
     def _get_origin_model_fields(self, model_name):
-        return {f['name']: {'type': f['ttype'], 'relation': f['relation']} for f in
+        return {f['name']: {'type': f['ttype'], 'relation': f['relation'], 'relation_field': f['relation_field'],
+                            'domain': f['domain']} for f in
                 self.connection.get_model('ir.model.fields').search_read(
-                    [('model', '=', model_name), ('name', '!=', '__last_update')], ['name', 'ttype', 'relation'])}
+                    [('model', '=', model_name), ('name', '!=', '__last_update')],
+                    ['name', 'ttype', 'relation', 'relation_field', 'domain'])}
 
     def search_all(self, model_name, domain):
         """Search active=True and active=False if exists"""
@@ -187,8 +393,271 @@ class MigrateToolBase(object):
             res = self.env[model_name].search(domain)
         return res
 
+    def get_id_map(self, model_name):
+        """Return the {old id: new id} dict of an origin model.
+        It's loaded from the target database with a single query the first time it's needed
+        and then kept up to date by the import methods.
+        """
+        id_map = self._id_maps.get(model_name)
+        if id_map is None:
+            id_map = self._id_maps[model_name] = self._load_id_map(model_name)
+        return id_map
+
+    def _load_id_map(self, model_name, old_ids=None):
+        """Read {old id: new id} from the database, only for old_ids when given"""
+        new_model_name = self._get_new_model(model_name)
+        rs = self.env[new_model_name]
+        field_name = self._old_id_field(model_name)
+        field = rs._fields.get(field_name)
+        if field is None:
+            # ensure_old_id didn't run yet, so nothing was imported
+            return {}
+        # archived records first so the active one wins when the same old id was imported twice
+        order = 'active' in rs._fields and 'active, id' or 'id'
+        if field.store and not field.inherited:
+            self.env.flush_all()
+            if old_ids is None:
+                self.env.cr.execute('SELECT "%s", id FROM "%s" WHERE "%s" > 0 ORDER BY %s' % (
+                    field_name, rs._table, field_name, order))
+            else:
+                self.env.cr.execute('SELECT "%s", id FROM "%s" WHERE "%s" = ANY(%%s) ORDER BY %s' % (
+                    field_name, rs._table, field_name, order), [list(old_ids)])
+            rows = self.env.cr.fetchall()
+        else:
+            # e.g. x_res_users_id stored on res.partner
+            domain = old_ids is None and [(field_name, '>', 0)] or [(field_name, 'in', list(old_ids))]
+            rows = [(r[field_name], r['id']) for r in rs.with_context(active_test=False).search_read(
+                domain, [field_name], order=order)]
+        return dict(rows)
+
+    def map_old_id(self, model_name, old_id):
+        """Return the new id of the record imported from old_id of the origin model_name or False"""
+        return self.get_id_map(model_name).get(old_id, False)
+
+    def map_old_ids(self, model_name, old_ids):
+        """Return {old id: new id} for the old_ids of model_name that were imported.
+        Uses the id map when it's already loaded, otherwise a single query for these ids only,
+        so big relation tables don't need to be loaded in memory.
+        """
+        old_ids = set(old_ids)
+        id_map = self._id_maps.get(model_name)
+        if id_map is None:
+            id_map = old_ids and self._load_id_map(model_name, old_ids) or {}
+        return {old_id: id_map[old_id] for old_id in old_ids if old_id in id_map}
+
+    def _register_old_id(self, model_name, old_id, new_id):
+        id_map = self._id_maps.get(model_name)
+        if id_map is not None and old_id:
+            self._id_map_log.append((model_name, old_id, id_map.get(old_id)))
+            id_map[old_id] = new_id
+
+    def invalidate_id_maps(self, model_name=None):
+        """Drop the cached id maps, they are reloaded on next use. Needed after a rollback."""
+        if model_name:
+            self._id_maps.pop(model_name, None)
+        else:
+            self._id_maps.clear()
+
+    def commit(self, batches=(), checkpoint=None, done_ids=(), failed_ids=()):
+        """Create the queued records of batches and commit.
+        The checkpoint, if any, moves forward with the remote ids done and failed.
+        """
+        for batch in batches:
+            batch.flush()
+        self.env.flush_all()
+        state = checkpoint and checkpoint.next_state(done_ids, failed_ids)
+        if checkpoint and checkpoint.store.transactional:
+            checkpoint.save(state)
+        self.env.cr.commit()
+        if checkpoint:
+            if not checkpoint.store.transactional:
+                checkpoint.save(state)
+            checkpoint.apply(state)
+        self._id_map_log = []
+        for matcher in self._key_matchers.values():
+            matcher.commit()
+
+    def rollback(self, batches=()):
+        """Rollback and forget everything done since the last commit, including the id map entries"""
+        self.env.cr.rollback()
+        for batch in batches:
+            batch.clear()
+        for model_name, old_id, new_id in reversed(self._id_map_log):
+            id_map = self._id_maps.get(model_name)
+            if id_map is None:
+                continue
+            if new_id is None:
+                id_map.pop(old_id, None)
+            else:
+                id_map[old_id] = new_id
+        self._id_map_log = []
+        for matcher in self._key_matchers.values():
+            matcher.rollback()
+
+    def _run_batched(self, phase, records, process, batches=(), checkpoint=None):
+        """Call process(record) for each record and commit following the commit policy of the phase.
+        When something fails the records since the last commit are rolled back and processed again
+        one at a time, each with its own commit, so only the failing record is lost.
+
+        :param phase: phase name used to get the commit policy
+        :param records: iterable of remote records, and FLUSH_BATCHES
+        :param process: function called with one record, it may change it
+        :param batches: CreateBatch to flush before each commit
+        :param checkpoint: Checkpoint saved with each commit
+        :return: the remote ids that failed, skipped with skip_errors
+        """
+        policy = self.commit_policy.for_phase(phase)
+        # time spent reading the remote pages, processing the records and committing
+        rpc_timer, self._rpc_timer = self._rpc_timer, self.metrics.timer(self.model_name, phase, 'rpc')
+        process = self.metrics.timed(process, self.model_name, phase, 'orm')
+        commit_timer = self.metrics.timer(self.model_name, phase, 'commit')
+        pending, started, failed = [], time.monotonic(), []
+        try:
+            with self.metrics.timer(self.model_name, phase, 'wall'):
+                for rec in records:
+                    if rec is FLUSH_BATCHES:
+                        try:
+                            for batch in batches:
+                                batch.flush()
+                        except Exception as e:
+                            failed += self._retry_one_by_one(phase, policy, pending, process, batches, checkpoint, e)
+                            pending, started = [], time.monotonic()
+                        continue
+                    pending.append(dict(rec))
+                    try:
+                        process(rec)
+                        if policy.is_due(len(pending), started):
+                            with commit_timer:
+                                self.commit(batches, checkpoint, [r['id'] for r in pending])
+                            self._report_progress(phase, [r['id'] for r in pending])
+                            pending, started = [], time.monotonic()
+                    except Exception as e:
+                        failed += self._retry_one_by_one(phase, policy, pending, process, batches, checkpoint, e)
+                        pending, started = [], time.monotonic()
+                if pending:
+                    try:
+                        with commit_timer:
+                            self.commit(batches, checkpoint, [r['id'] for r in pending])
+                        self._report_progress(phase, [r['id'] for r in pending])
+                    except Exception as e:
+                        failed += self._retry_one_by_one(phase, policy, pending, process, batches, checkpoint, e)
+        finally:
+            self._rpc_timer = rpc_timer
+        return failed
+
+    def _retry_one_by_one(self, phase, policy, records, process, batches, checkpoint, error):
+        self.rollback(batches)
+        _logger.warning('MIG: ... %s failed (%s), retrying %s records one by one' % (phase, error, len(records)))
+        commit_timer = self.metrics.timer(self.model_name, phase, 'commit')
+        failed = []
+        for rec in records:
+            try:
+                process(dict(rec))
+                with commit_timer:
+                    self.commit(batches, checkpoint, [rec['id']])
+                self._report_progress(phase, [rec['id']])
+            except Exception as e:
+                self.rollback(batches)
+                if not policy.skip_errors:
+                    raise
+                _logger.error('MIG: ... %s failed for record %s: %s' % (phase, rec_to_str(rec), e))
+                if checkpoint:
+                    # keep it for the next run
+                    self.commit(checkpoint=checkpoint, failed_ids=[rec['id']])
+                self._report_progress(phase, failed_ids=[rec['id']])
+                failed.append(rec['id'])
+        return failed
+
+    def _get_watermark(self, model_name, phase):
+        """Watermark of the phase when running incrementally, None otherwise"""
+        info = self._get_field_info_dict(model_name)
+        if not (self.incremental and self.checkpoint_store and info.get('incremental', True)):
+            return None
+        latest = self.remote_search_all(model_name, [], ['write_date'], limit=1, order='write_date desc')
+        return Watermark(self.checkpoint_store, model_name, phase, latest and latest[0]['write_date'] or None,
+                         info.get('incremental_overlap', self.INCREMENTAL_OVERLAP))
+
+    def _save_watermark(self, watermark, failed_ids=()):
+        """Called once the phase is done, by the coordinator when it runs in partitions.
+        The watermark stays where it was when records failed: the next run reads them again.
+        """
+        if watermark and failed_ids and not self.partition:
+            _logger.warning('MIG: ... %s %s records failed, the watermark of %s stays at %s' % (
+                len(failed_ids), watermark.model_name, watermark.phase, watermark.value))
+        elif watermark and not self.partition:
+            watermark.save()
+            if watermark.store.transactional:
+                self.env.cr.commit()
+
+    def detect_deleted(self, model_name, unlink=False):
+        """Return the old ids imported whose remote record doesn't exist anymore.
+        With unlink, their local records are deleted too.
+        """
+        remote_rs = self.connection.get_model(model_name)
+        page_size = 10 * self._get_page_size(model_name)
+        domain_active = ['|', ('active', '=', False), ('active', '=', True)]
+        remote_ids, last_id = set(), 0
+        while True:
+            try:
+                ids = remote_rs.search(domain_active + [('id', '>', last_id)], 0, page_size, 'id')
+            except JsonRPCException:
+                if not domain_active:
+                    raise
+                domain_active = []
+                continue
+            remote_ids.update(ids)
+            if len(ids) < page_size:
+                break
+            last_id = ids[-1]
+        id_map = self.get_id_map(model_name)
+        deleted = sorted(set(id_map) - remote_ids)
+        _logger.info('MIG: ... %s %s records deleted on the remote server' % (len(deleted), model_name))
+        if deleted and unlink:
+            new_model_name = self._get_new_model(model_name)
+            self.env[new_model_name].browse([id_map[old_id] for old_id in deleted]).unlink()
+            self.commit()
+            self.invalidate_id_maps(model_name)
+        return deleted
+
+    def _report_progress(self, phase, done_ids=(), failed_ids=()):
+        if done_ids:
+            self.metrics.committed(self.model_name, phase, len(done_ids))
+        if failed_ids:
+            self.metrics.count(self.model_name, phase, 'errors', len(failed_ids))
+        if self.progress_callback:
+            self.progress_callback(phase, done_ids, failed_ids)
+
+    def _get_workers(self, model_name):
+        if not self.MODEL_INFO:
+            self._get_model_info_dict()
+        return self.MODEL_INFO.get(model_name, {}).get('workers') or 1
+
+    def _partition_domain(self):
+        """Remote domain of the records handled by this process"""
+        if not self.partition:
+            return []
+        return [('id', '>=', self.partition[0]), ('id', '<=', self.partition[1])]
+
+    def _run_partitioned(self, method_name, model_name, *args):
+        """Run method_name in the worker processes of the 'workers' of the model config.
+        The watermark of the phase is saved here, once all of them are done.
+        """
+        _logger.info('MIG: ... %s %s in %s processes' % (method_name, model_name, self._get_workers(model_name)))
+        watermark = self._get_watermark(model_name, method_name)
+        res = run_partitioned(self, method_name, model_name, self._get_workers(model_name), args)
+        if res['failed']:
+            _logger.error('MIG: ... %s %s skipped the remote ids %s' % (method_name, model_name, res['failed']))
+        if res['errors']:
+            raise MigrationError('%s %s failed in partitions %s' % (method_name, model_name, sorted(res['errors'])))
+        self._save_watermark(watermark, res['failed'])
+        return res
+
     def remote_search_all(self, model_name, domain=None, fields=None, offset=0, limit=None, order=None):
-        """Search active=True and active=False if exists"""
+        """Search active=True and active=False if exists, return a list.
+        Ordered by id, the records are read in pages: use remote_iter_records to get them lazily.
+        """
+        if not offset and (order or 'id').lower() in ('id', 'id asc'):
+            return list(self.remote_iter_records(model_name, domain, fields, limit=limit, include_archived=True))
         remote_rs = self.connection.get_model(model_name)
         domain_all = ['|', ('active', '=', False), ('active', '=', True)]
         domain_all.extend(domain)
@@ -200,37 +669,111 @@ class MigrateToolBase(object):
             res = remote_rs.search_read(domain=domain, fields=fields, offset=offset, limit=limit, order=order)
         return res
 
-    def copy_chatter(self, model_name):
-        """This is a really simplistic way of copying chatter"""
+    def _get_page_size(self, model_name):
+        if not self.MODEL_INFO:
+            self._get_model_info_dict()
+        return self.MODEL_INFO.get(model_name, {}).get('page_size') or self.PAGE_SIZE
+
+    def _get_prefetch(self, model_name):
+        if not self.MODEL_INFO:
+            self._get_model_info_dict()
+        workers = self.MODEL_INFO.get(model_name, {}).get('prefetch_workers', self.prefetch_workers)
+        if workers and workers not in self._prefetch:
+            self._prefetch[workers] = PrefetchPipeline(self.connection, workers, self.prefetch_depth)
+        return workers and self._prefetch[workers]
+
+    def remote_iter_pages(self, model_name, domain=None, fields=None, limit=None, page_size=None,
+                          include_archived=False):
+        """Yield the remote records as lists of at most page_size records, ordered by id.
+
+        Pages are fetched with keyset pagination (id > last id of the previous page) so every
+        request stays cheap on the server, whatever the size of the table.
+
+        :param model_name: remote model name
+        :param domain: extra domain
+        :param fields: fields to read, 'id' is always returned
+        :param limit: maximum number of records to yield, falsy means all
+        :param page_size: defaults to the 'page_size' of the model config or PAGE_SIZE
+        :param include_archived: search active=True and active=False if exists
+        """
+        remote_rs = self.connection.get_model(model_name)
+        page_size = page_size or self._get_page_size(model_name)
+        domain = list(domain or [])
+        domain_active = include_archived and ['|', ('active', '=', False), ('active', '=', True)] or []
+        prefetch = self._get_prefetch(model_name)
+        if prefetch:
+            pages = prefetch.iter_pages(model_name, domain, fields, page_size, limit, domain_active)
+            while True:
+                # the time waiting for the prefetched pages
+                with self._rpc_timer:
+                    page = next(pages, None)
+                if page is None:
+                    return
+                yield page
+        last_id, count = 0, 0
+        while True:
+            size = limit and min(page_size, limit - count) or page_size
+            try:
+                with self._rpc_timer:
+                    page = remote_rs.search_read(domain=domain_active + domain + [('id', '>', last_id)],
+                                                 fields=fields, limit=size, order='id')
+            except JsonRPCException:
+                if not domain_active:
+                    raise
+                # if "Invalid field op.project.active in leaf ('active', '=', True)"
+                domain_active = []
+                continue
+            if not page:
+                return
+            # read before yielding, consumers are free to alter the records
+            count += len(page)
+            last_id = page[-1]['id']
+            yield page
+            if len(page) < size or (limit and count >= limit):
+                return
+
+    def remote_iter_records(self, model_name, domain=None, fields=None, limit=None, page_size=None,
+                            include_archived=False):
+        """Same as remote_iter_pages but yields one record at a time"""
+        for page in self.remote_iter_pages(model_name, domain, fields, limit=limit, page_size=page_size,
+                                           include_archived=include_archived):
+            yield from page
+
+    def copy_chatter(self, model_name, bulk=False):
+        """This is a really simplistic way of copying chatter.
+        With bulk=True messages are copied with copy_chatter_bulk instead of message_post.
+        """
+        if bulk:
+            return self.copy_chatter_bulk(model_name)
         self.ensure_model(model_name)
         info = self._get_field_info_dict(model_name)
         key_fields, include_archived, new_model_name, create_record, extra_args = \
             info['key_fields'], info['include_archived'], info['new_model_name'], info['create'], info['extra_args']
         rs = self.env[new_model_name].with_context(**DISABLED_MAIL_CONTEXT)
-        rs_partner = self.env['res.partner'].with_context(**DISABLED_MAIL_CONTEXT)
-        remote_rs = self.connection.get_model(model_name)
         domain = []
-        for rec in remote_rs.search_read(domain, ['message_ids'], order="create_date DESC"):
-            local_rec = rs.search([('x_%s_id' % model_name.replace('.', '_'), '=', rec['id'])], limit=1)
+        fields = ['author_id', 'subject', 'body', 'email_from', 'reply_to', 'message_type', 'message_id',
+                  'description', 'date']
+
+        def records():
+            for rec in self.remote_iter_records(model_name, domain, ['message_ids']):
+                local_rec = rs.browse(self.map_old_id(model_name, rec['id']))
+                rec['messages'] = []
+                if local_rec and len(local_rec.message_ids) != len(rec['message_ids']):
+                    # read here to be timed as rpc, not in process
+                    with self._rpc_timer:
+                        rec['messages'] = self.connection.get_model('mail.message').search_read([
+                            ('id', 'in', rec['message_ids'])], fields)
+                yield rec
+
+        def process(rec):
+            local_rec = rs.browse(self.map_old_id(model_name, rec['id']))
             if len(local_rec.message_ids) == len(rec['message_ids']):
                 self.iprint("Nothing to import for x_%s_id=%s" % (model_name.replace('.', '_'), rec['id']),
                             verbose=True)
-                continue
+                return
             if local_rec and len(local_rec.message_ids) != len(rec['message_ids']):
-                for msg in self.connection.get_model('mail.message').search_read([
-                    ('id', 'in', rec['message_ids'])],
-                        [
-                            'author_id',
-                            'subject',
-                            'body',
-                            'email_from',
-                            'reply_to',
-                            'message_type',
-                            'message_id',
-                            'description',
-                            'date'
-                        ]):
-                    author_rec = rs_partner.search([('x_res_partner_id', '=', msg['author_id'][0])], limit=1)
+                for msg in rec['messages']:
+                    author_id = msg['author_id'] and self.map_old_id('res.partner', msg['author_id'][0])
                     local_rec.message_post(
                         email_from=msg['email_from'],
                         reply_to=msg['reply_to'],
@@ -240,16 +783,201 @@ class MigrateToolBase(object):
                         subject=msg['subject'],
                         description=msg['description'],
                         body=msg['body'],
-                        author_id=author_rec.id
+                        author_id=author_id
                     )
             else:
                 self.iprint("ERROR: No lead found for x_%s_id=%s" % (model_name.replace('.', '_'), rec['id']),
                             verbose=True)
-        self.env.cr.commit()
+
+        self._run_batched('copy_chatter', records(), process)
+
+    def copy_chatter_bulk(self, model_name, resume=True):
+        """Copy the messages of model_name in bulk: the remote messages are read in pages ordered by id
+        across all the records, their record and author resolved through the id maps, and they are
+        inserted with mail.message create, skipping message_post and the notifications.
+
+        Copied messages keep their old id in x_mail_message_id, with resume=True the copy starts
+        after the last message already copied for this model.
+        """
+        self.ensure_model(model_name)
+        new_model_name = self.new_model_name
+        msg_old_id = self._old_id_field('mail.message')
+        self.ensure_old_id('mail.message', 'mail.message')
+        rs_message = self.env['mail.message'].with_context(**DISABLED_MAIL_CONTEXT)
+        local_fields = rs_message._fields
+        fields = [f for f in ['author_id', 'subject', 'body', 'email_from', 'reply_to', 'message_type',
+                              'message_id', 'description', 'date', 'parent_id'] if f in local_fields] + ['res_id']
+        domain = [('model', '=', model_name)]
+        if resume:
+            self.env.flush_all()
+            self.env.cr.execute('SELECT max("%s") FROM mail_message WHERE model = %%s' % msg_old_id,
+                                [new_model_name])
+            last_id = self.env.cr.fetchone()[0]
+            if last_id:
+                _logger.info('MIG: ... copy_chatter_bulk: resuming %s after message %s' % (model_name, last_id))
+                domain.append(('id', '>', last_id))
+        authors = 'res.partner' in self.MODEL_INFO and self.get_id_map('res.partner') or {}
+        # old message id: old parent id, until the message is created
+        replies = {}
+
+        def link_replies(vals_list, records):
+            children = {}
+            for vals, record in zip(vals_list, records):
+                old_parent_id = replies.pop(vals[msg_old_id], None)
+                if old_parent_id:
+                    children.setdefault(old_parent_id, []).append(record.id)
+            if not children:
+                return
+            self.env.flush_all()
+            self.env.cr.execute('SELECT "%s", id FROM mail_message WHERE "%s" = ANY(%%s)' % (
+                msg_old_id, msg_old_id), [list(children)])
+            for old_parent_id, parent_id in self.env.cr.fetchall():
+                rs_message.browse(children[old_parent_id]).write({'parent_id': parent_id})
+
+        batch = CreateBatch(rs_message, self._get_page_size('mail.message'), on_create=link_replies)
+
+        def records():
+            for page in self.remote_iter_pages('mail.message', domain, fields):
+                res_ids = self.map_old_ids(model_name, [msg['res_id'] for msg in page])
+                for msg in page:
+                    if msg['res_id'] in res_ids:
+                        msg['res_id'] = res_ids[msg['res_id']]
+                        yield msg
+
+        def process(msg):
+            vals = get_first_from_id(msg)
+            vals[msg_old_id] = vals.pop('id')
+            vals['model'] = new_model_name
+            vals['author_id'] = authors.get(vals.get('author_id'), False)
+            if vals.get('parent_id'):
+                # linked once both are created, the parent may be in the same batch
+                replies[vals[msg_old_id]] = vals.pop('parent_id')
+            batch.add(vals)
+
+        self._run_batched('copy_chatter', records(), process, batches=[batch])
+
+    def copy_attachments(self, model_names=None, workers=4, download='http', resume=True, binary_fields=None):
+        """Copy the attachments of the records imported, including the binary fields stored as attachments.
+
+        The remote attachments are read in pages ordered by id, their record resolved through the id maps,
+        their content copied into the local filestore by an AttachmentDownloader (`workers` at a time,
+        streamed with download='http', read from datas with 'rpc') and they are inserted with a
+        SqlCreateBatch: ir.attachment create would write the files again. Attachments of records that were
+        not imported and of binary fields without a local field are skipped.
+
+        Copied attachments keep their old id in x_ir_attachment_id, with resume=True the copy of each model
+        starts after the last attachment already copied for it. A content that failed to download is logged and copied by the
+        next run with resume=False.
+
+        :param model_names: old models of the attachments, all the models of the config by default
+        :param binary_fields: {old model: {old field: new field}}, binary fields of the same name by default
+        """
+        if not self.MODEL_INFO:
+            self._get_model_info_dict()
+        if isinstance(model_names, str):
+            model_names = [model_names]
+        model_names = list(model_names or self.MODEL_INFO)
+        att_old_id = self._old_id_field('ir.attachment')
+        self.ensure_old_id('ir.attachment', 'ir.attachment')
+        rs = self.env['ir.attachment'].with_context(**DISABLED_MAIL_CONTEXT)
+        if rs._storage() != 'file':
+            raise MigrationError('Attachments are stored in the database, set ir_attachment.location to file')
+        local_fields = rs._fields
+        remote_fields = self._get_origin_model_fields('ir.attachment')
+        fields = [f for f in ['name', 'datas_fname', 'res_model', 'res_field', 'res_id', 'type', 'url', 'public',
+                              'access_token', 'mimetype', 'description', 'checksum', 'file_size'] if f in remote_fields]
+        # {old model: (new model, {old binary field: new binary field})}
+        targets = {}
+        for model_name in model_names:
+            new_model_name = self._get_new_model(model_name)
+            field_map = {name: name for name, field in self.env[new_model_name]._fields.items()
+                         if field.type == 'binary' and field.attachment}
+            field_map.update((binary_fields or {}).get(model_name) or {})
+            targets[model_name] = (new_model_name, field_map)
+        last_ids = {}
+        if resume:
+            self.env.flush_all()
+            self.env.cr.execute(
+                'SELECT res_model, max("%s") FROM ir_attachment WHERE res_model = ANY(%%s) GROUP BY res_model' % (
+                    att_old_id), [list({new_model_name for new_model_name, _field_map in targets.values()})])
+            last_ids = dict(self.env.cr.fetchall())
+        # res_field=False is added to the domain by the server unless res_field is in it
+        domain = ['|', ('res_field', '=', False), ('res_field', '!=', False)] + ['|'] * (len(model_names) - 1)
+        for model_name in model_names:
+            last_id = last_ids.get(targets[model_name][0])
+            if last_id:
+                _logger.info('MIG: ... copy_attachments: resuming %s after attachment %s' % (model_name, last_id))
+                domain.extend(['&', ('res_model', '=', model_name), ('id', '>', last_id)])
+            else:
+                domain.append(('res_model', '=', model_name))
+        downloader = AttachmentDownloader(self.connection, rs._filestore(), workers, download)
+        skipped = dict.fromkeys(['already copied', 'record not imported', 'no binary field', 'download failed'], 0)
+
+        def mark_modified(vals_list, records):
+            # fields computed from binary fields, e.g. the resized images of image_1920
+            by_field = {}
+            for vals in vals_list:
+                if vals.get('res_field') and vals.get('res_id'):
+                    by_field.setdefault((vals['res_model'], vals['res_field']), []).append(vals['res_id'])
+            for (res_model, res_field), res_ids in by_field.items():
+                self.env[res_model].browse(res_ids).modified([res_field])
+
+        batch = SqlCreateBatch(rs, self._get_page_size('ir.attachment'), att_old_id, on_create=mark_modified)
+
+        def records():
+            for page in self.remote_iter_pages('ir.attachment', domain, fields):
+                self.env.cr.execute('SELECT "%s" FROM ir_attachment WHERE "%s" = ANY(%%s)' % (
+                    att_old_id, att_old_id), [[att['id'] for att in page]])
+                copied = {old_id for old_id, in self.env.cr.fetchall()}
+                res_ids = {model_name: self.map_old_ids(model_name, [
+                    att['res_id'] for att in page if att['res_model'] == model_name and att['res_id']])
+                    for model_name in {att['res_model'] for att in page}}
+                todo = []
+                for att in page:
+                    new_model_name, field_map = targets[att['res_model']]
+                    res_field = att['res_field'] and field_map.get(att['res_field'])
+                    if att['id'] in copied:
+                        skipped['already copied'] += 1
+                    elif att['res_id'] and att['res_id'] not in res_ids[att['res_model']]:
+                        skipped['record not imported'] += 1
+                    elif att['res_field'] and not res_field:
+                        skipped['no binary field'] += 1
+                    else:
+                        att.update(res_model=new_model_name, res_field=res_field or False,
+                                   res_id=att['res_id'] and res_ids[att['res_model']][att['res_id']] or 0)
+                        todo.append(att)
+                downloaded = downloader.bytes_downloaded
+                contents = downloader.download([att for att in todo if att.get('type', 'binary') == 'binary'])
+                self.metrics.count(self.model_name, 'copy_attachments', 'bytes_downloaded',
+                                   downloader.bytes_downloaded - downloaded)
+                downloader.report()
+                for att in todo:
+                    content = contents.get(att['id'])
+                    if isinstance(content, Exception):
+                        _logger.error('MIG: ... attachment %s not downloaded: %s' % (att['id'], content))
+                        skipped['download failed'] += 1
+                        continue
+                    if content:
+                        att['store_fname'], att['checksum'], att['file_size'] = content
+                    yield att
+
+        def process(att):
+            vals = {f: v for f, v in att.items() if f in local_fields and f != 'id'}
+            vals['name'] = att.get('datas_fname') or att['name']
+            vals[att_old_id] = att['id']
+            batch.add(vals)
+
+        with downloader:
+            self._run_batched('copy_attachments', records(), process, batches=[batch])
+        downloader.report()
+        _logger.info('MIG: ... copy_attachments: skipped %s' % ', '.join(
+            '%s %s' % (count, reason) for reason, count in skipped.items() if count) or 'nothing')
 
     def import_basic_types(self, model_name, force_fields=None):
         """It will import all : 'char', 'text', 'boolean', 'selection' type fields that have the same name.
         Use force fields to force them.
+        With a checkpoint store, the records whose remote values didn't change since the last run are
+        skipped, unless 'change_detection' is False in the model config.
 
         :param model_name:
         :param force_fields:
@@ -257,7 +985,10 @@ class MigrateToolBase(object):
         """
         if force_fields is None:
             force_fields = []
+        # the old id field is created before forking, once
         self.ensure_model(model_name)
+        if self._get_workers(model_name) > 1 and not self.partition:
+            return self._run_partitioned('import_basic_types', model_name, force_fields)
         self.iprint("\n import chars: %s \n" % (self.model_name), verbose=True)
 
         def different_items(y, x):
@@ -267,94 +998,140 @@ class MigrateToolBase(object):
         key_fields, include_archived, new_model_name, create_record, extra_args = \
             info['key_fields'], info['include_archived'], info['new_model_name'], info['create'], info['extra_args']
         rs = self.env[new_model_name].with_context(recompute=False, **DISABLED_MAIL_CONTEXT)
-        remote_rs = self.connection.get_model(model_name)
         transform_name = extra_args.get('transform', False)
-        field_list = self.matching_char_fields
-        if force_fields:
-            field_list.extend(force_fields)
+        field_list = self.matching_char_fields + force_fields
+
+        batch = self._get_create_batch(model_name, rs)
+        # existing records are updated without being read first
+        writes = self._is_sql_load(model_name, rs) and SqlWriteBatch(rs)
+        row_hashes = self.checkpoint_store and info.get('change_detection', True) and \
+            RowHashes(self.checkpoint_store, model_name, field_list)
+        watermark = self._get_watermark(model_name, 'import_basic_types')
 
-        for rec in remote_rs.search_read([], field_list):
-            local_rec = rs.search([('x_%s_id' % model_name.replace('.', '_'), '=', rec['id'])])
+        def records():
+            domain = self._partition_domain() + (watermark and watermark.domain() or [])
+            for page in self.remote_iter_pages(model_name, domain, field_list):
+                if row_hashes:
+                    row_hashes.load([rec['id'] for rec in page])
+                yield from page
+
+        def process(rec):
+            local_rec = rs.browse(self.map_old_id(model_name, rec['id']))
+            if row_hashes and not row_hashes.changed(rec) and local_rec:
+                return
             if transform_name:
                 transform = getattr(self, transform_name)
-                rec, key_fields = transform(rec, key_fields)
+                rec, _key_fields = transform(rec, key_fields)
             if not local_rec:
                 rec = rename_id(rec, model_name)
+                if batch:
+                    batch.add(rec)
+                    return
                 local_rec = rs.create(rec)
+                self._register_old_id(model_name, rec[self._old_id_field(model_name)], local_rec.id)
+            elif writes:
+                writes.add(local_rec.id, {k: v for k, v in rec.items() if k in rs._fields and k != 'id'})
             else:
-                existing_rec_vals = local_rec.read([])[0]
+                # only the fields imported
+                fields_read = [k for k in rec if k in rs._fields and k != 'id']
+                if not fields_read:
+                    return
+                existing_rec_vals = local_rec.read(fields_read)[0]
                 existing_rec_vals.pop('id', None)
                 diff_dict = different_items(existing_rec_vals, rec)
 
                 if diff_dict:
                     local_rec.write(diff_dict)
-            self.env.cr.commit()
-            self.env.flush_all()
+
+        failed = self._run_batched('import_basic_types', records(), process,
+                                   batches=[b for b in (batch, writes) if b], checkpoint=row_hashes)
+        self._save_watermark(watermark, failed)
 
     def update_many2one_fields(self, model_name, fields):
         """Run after you are happy with the result of check_fixed_models"""
         self.ensure_model(model_name)
-        new_model_name = self._get_field_info_dict(model_name)['new_model_name']
+        new_model_name = self._get_new_model(model_name)
         rs = self.env[new_model_name].with_context(**DISABLED_MAIL_CONTEXT)
-        remote_rs = self.connection.get_model(model_name)
-        for rec in remote_rs.search_read([], fields, limit=self.test_mode and 100 or 0):
-            match = rs.search([('x_%s_id' % model_name.replace('.', '_'), '=', rec['id'])])
-            if match:
+        writes = self._get_write_batch(model_name, rs)
+        watermark = self._get_watermark(model_name, 'update_many2one_fields')
+
+        def process(rec):
+            match_id = self.map_old_id(model_name, rec['id'])
+            if match_id:
                 vals = {}
                 for fld in fields:
                     match_model = self.target_fields[fld]['relation']
                     match_old_model = self._get_old_model(match_model)
                     if rec[fld]:
-                        vals[fld] = self.search_all(match_model, [
-                            ('x_%s_id' % match_old_model.replace('.', '_'), '=', rec[fld][0])]).id
+                        vals[fld] = self.map_old_id(match_old_model, rec[fld][0])
                 if vals:
-                    match.write(vals)
+                    writes.add(match_id, vals)
                     _logger.info('MIG: ... update_many2one_fields: %s ' % vals)
-            self.env.cr.commit()
 
-    def update_many2many_fields(self, model_name, fields, verbose=False):
-        """Run after you are happy with the result of check_fixed_models"""
+        failed = self._run_batched('update_many2one_fields', self.remote_iter_records(
+            model_name, watermark and watermark.domain() or [], fields, limit=self.test_mode and 100 or 0),
+            process, batches=[writes])
+        self._save_watermark(watermark, failed)
+
+    def update_many2many_fields(self, model_name, fields, verbose=False, clear_empty=False):
+        """Run after you are happy with the result of check_fixed_models.
+        Fields empty on the remote record are left alone, unless clear_empty is set.
+        """
         self.ensure_model(model_name)
-        new_model_name = self._get_field_info_dict(model_name)['new_model_name']
+        new_model_name = self._get_new_model(model_name)
         rs = self.env[new_model_name].with_context(**DISABLED_MAIL_CONTEXT)
-        remote_rs = self.connection.get_model(model_name)
-        for rec in remote_rs.search_read([], fields):
-            match = rs.search([('x_%s_id' % model_name.replace('.', '_'), '=', rec['id'])])
-            if match:
-                vals = {}
-                for fld in fields:
-                    match_model = self.target_fields[fld]['relation']
-                    match_old_model = self._get_old_model(match_model)
-                    if rec[fld]:
-                        vals[fld] = self.env[match_model].search(
-                            [('x_%s_id' % match_old_model.replace('.', '_'), 'in', rec[fld])]).ids
-                if vals:
-                    vals_conv = {k: [(6, 0, v)] for k, v in vals.items()}
-                    match.write(vals_conv)
-                    self.env.cr.commit()
+        writes = WriteBatch(rs)
+        relations = {fld: self._get_old_model(self.target_fields[fld]['relation']) for fld in fields}
+        watermark = self._get_watermark(model_name, 'update_many2many_fields')
+
+        def records():
+            # resolve the ids of a whole page with one query per relation
+            for page in self.remote_iter_pages(model_name, watermark and watermark.domain() or [], fields):
+                match_ids = self.map_old_ids(model_name, [rec['id'] for rec in page])
+                page = [rec for rec in page if rec['id'] in match_ids]
+                for fld, match_old_model in relations.items():
+                    id_map = self.map_old_ids(match_old_model, {old_id for rec in page for old_id in rec[fld]})
+                    for rec in page:
+                        # sorted so records with the same set of ids share one write
+                        rec[fld] = sorted(id_map[old_id] for old_id in rec[fld] if old_id in id_map) \
+                            if rec[fld] else ([] if clear_empty else False)
+                for rec in page:
+                    rec['_new_id'] = match_ids[rec['id']]
+                    yield rec
 
-    def update_one2many_fields(self, model_name, field, extra_domain=[], create=True, verbose=False):
-        """Update existing record with one2many. Doesn't create new records on model_name"""
+        def process(rec):
+            vals = {fld: [(6, 0, rec[fld])] for fld in fields if rec[fld] is not False}
+            if vals:
+                writes.add(rec['_new_id'], vals)
+
+        failed = self._run_batched('update_many2many_fields', records(), process, batches=[writes])
+        self._save_watermark(watermark, failed)
+
+    def update_one2many_fields(self, model_name, field, extra_domain=[], create=True, verbose=False, bulk=False):
+        """Update existing record with one2many. Doesn't create new records on model_name
+        With bulk=True the children are imported with update_one2many_fields_bulk instead, for big tables.
+        """
+        if bulk:
+            return self.update_one2many_fields_bulk(model_name, field, extra_domain, create)
         self.ensure_model(model_name)
-        new_model_name = self._get_field_info_dict(model_name)['new_model_name']
+        new_model_name = self._get_new_model(model_name)
         rs = self.env[new_model_name].with_context(**DISABLED_MAIL_CONTEXT)
-        remote_rs = self.connection.get_model(model_name)
-        for rec in remote_rs.search_read([], [field], limit=100):
-            target_record = rs.search([('x_%s_id' % model_name.replace('.', '_'), '=', rec['id'])])
+        for rec in self.remote_iter_records(model_name, [], [field], limit=100):
+            target_record = rs.browse(self.map_old_id(model_name, rec['id']))
             if target_record:
                 # get relation model
                 relation_model = self.target_fields[field]['relation']
                 relation_field = self.target_fields[field]['relation_field']
-                relation_domain_filter = self.target_fields[field]['domain']
+                relation_domain_filter = parse_domain(self.target_fields[field]['domain'])
                 # get mapping for the relation model
-                new_model_name = self._get_field_info_dict(relation_model)['new_model_name']
+                new_model_name = self._get_new_model(relation_model)
                 related_rs = self.env[new_model_name].with_context(**DISABLED_MAIL_CONTEXT)
                 related_key_fields = self._get_field_info_dict(relation_model)['key_fields']
                 extra_args = self._get_field_info_dict(relation_model)['extra_args']
                 transform_name = extra_args.get('transform', False)
                 related_domain = relation_domain_filter + [(relation_field, '=', rec['id'])] + extra_domain
                 for ro_id in self.connection.get_model(relation_model).search(related_domain):
-                    rel_match = related_rs.search([('x_%s_id' % model_name.replace('.', '_'), '=', ro_id)])
+                    rel_match = related_rs.browse(self.map_old_id(relation_model, ro_id))
 
                     if rel_match:
                         self.iprint("|---> updating ", new_model_name)
@@ -366,59 +1143,179 @@ class MigrateToolBase(object):
                         if vals and transform_name:
                             transform = getattr(self, transform_name)
                             vals = transform(vals)
-                        vals = rename_id(vals, model_name)
+                        vals = rename_id(vals, relation_model)
                         vals = get_first_from_id(vals)
                         if vals:
                             self.iprint("|---> vals: ", vals)
-                            related_rs.create(vals)
+                            new_rec = related_rs.create(vals)
+                            self._register_old_id(relation_model, ro_id, new_rec.id)
             else:
                 self.iprint("-- no target record to update, you need to create them first")
-        self.env.cr.commit()
+        self.commit()
+
+    def update_one2many_fields_bulk(self, model_name, field, extra_domain=None, create=True):
+        """Import the children of the one2many field of model_name for all the parents at once: the remote
+        children are read in pages ordered by id, their parent and other *_id fields resolved through the
+        id maps and the missing ones created in batches of 'create_batch_size' of the child model config,
+        by default its page size. Children already imported or whose parent is not imported are skipped.
+
+        The child model must be in the config. Its key_fields and required_fields are imported.
+        """
+        self.ensure_model(model_name)
+        meta = self.get_model_metadata(model_name)
+        origin_field = meta['origin_fields'].get(field)
+        target_field = meta['target_fields'].get(field)
+        if not origin_field or origin_field['type'] != 'one2many' or not target_field:
+            raise MigrationError('%s is not a one2many field of %s on both servers' % (field, model_name))
+        child_model = origin_field['relation']
+        inverse_field, new_inverse_field = origin_field['relation_field'], target_field['relation_field']
+        info = self._get_field_info_dict(child_model)
+        transform_name = info['extra_args'].get('transform', False)
+        key_fields = info['key_fields']
+        fields = list(dict.fromkeys([f for f in key_fields + info['required_fields'] if f != 'id'] + [inverse_field]))
+        related_rs = self.env[info['new_model_name']].with_context(**DISABLED_MAIL_CONTEXT)
+        self.ensure_old_id(child_model, info['new_model_name'])
+        batch = self._get_create_batch(child_model, related_rs, default_size=self._get_page_size(child_model))
+        domain = parse_domain(origin_field['domain']) + [(inverse_field, '!=', False)] + info['domain'] + \
+            list(extra_domain or [])
+        # children skipped, by reason
+        skipped = {'imported': 0, 'no parent': 0, 'not created': 0}
+        _logger.info('MIG: ... importing %s of %s (%s records)' % (field, model_name, child_model))
+
+        def records():
+            for page in self.remote_iter_pages(child_model, domain, fields,
+                                               include_archived=info.get('include_archived', False)):
+                imported = self.map_old_ids(child_model, [rec['id'] for rec in page])
+                parents = self.map_old_ids(model_name, [rec[inverse_field][0] for rec in page])
+                for rec in page:
+                    if rec['id'] in imported:
+                        skipped['imported'] += 1
+                    elif rec[inverse_field][0] not in parents:
+                        skipped['no parent'] += 1
+                    elif not create:
+                        skipped['not created'] += 1
+                    else:
+                        yield rec
+
+        def process(rec):
+            if transform_name:
+                rec, _key_fields = getattr(self, transform_name)(rec, key_fields)
+            parent_id = self.map_old_id(model_name, rec.pop(inverse_field)[0])
+            rec = rename_id(self._convert_id_records(child_model, rec), child_model)
+            rec[new_inverse_field] = parent_id
+            if batch:
+                batch.add(rec)
+                return
+            new_rec = related_rs.create(rec)
+            self._register_old_id(child_model, rec[self._old_id_field(child_model)], new_rec.id)
+
+        self._run_batched('update_one2many_fields', records(), process, batches=batch and [batch] or [])
+        _logger.info('MIG: ... %s of %s: skipped %s' % (field, model_name, ', '.join(
+            '%s %s' % (count, reason) for reason, count in skipped.items() if count) or 'nothing'))
 
     def _convert_id_records(self, model_name, rec):
         for k, v in rec.items():
             if k.endswith('_id') and v:
-                rel_model = self._get_origin_model_fields(model_name)[k]['relation']
+                rel_model = self.get_model_metadata(model_name)['origin_fields'][k]['relation']
                 if not rel_model:
                     # it's *_id but has no foreign object
                     continue
-                rel_model = self._get_field_info_dict(rel_model)['new_model_name']
-                rel_old_model = self._get_old_model(rel_model)
-                new_id = self.search_all(rel_model, [
-                    ('x_%s_id' % rel_old_model.replace('.', '_'), '=', rec[k][0])])
-                if len(new_id) == 0:
-                    rec[k] = False
-                elif len(new_id) == 1:
-                    rec[k] = new_id.id
-                elif len(new_id) == 2:
-                    rec[k] = new_id.filtered(lambda x: x.active is True)[0].id
-                else:
-                    raise Exception(
-                        'More/less than one match for the same x_old_id %s - x_old_id=%s' % (new_id, rec[k][0]))
+                rec[k] = self.map_old_id(rel_model, rec[k][0])
         return rec
 
-    def _handle_record(self, rs_model, key_fields, model_name, archived, create, record):
-        domain = []
-        if 'active' in key_fields or archived:
-            domain = ['|', ('active', '=', False), ('active', '=', True)] or []
-        # if key field is a "*_id" will return a <list>
-        domain.extend([(f, '=', record[f][0]) if type(record[f]) is list else (f, '=', record[f]) for f in key_fields])
-        match = rs_model.search(domain)
+    def _is_sql_load(self, model_name, rs):
+        """True when the model config has 'load_mode': 'sql', see SqlCreateBatch"""
+        mode = self._get_field_info_dict(model_name).get('load_mode', 'orm')
+        if mode not in ('orm', 'sql'):
+            raise MigrationError("load_mode of %s must be 'orm' or 'sql', not %r" % (model_name, mode))
+        if mode == 'sql' and rs._inherits:
+            raise MigrationError('%s inherits %s, it can only be loaded with the ORM' % (
+                rs._name, ', '.join(rs._inherits)))
+        return mode == 'sql'
+
+    def _get_create_batch(self, model_name, rs, default_size=1):
+        """Return a CreateBatch when 'create_batch_size' is set in the model config, otherwise None.
+        With 'load_mode': 'sql' it's always a SqlCreateBatch, by default of the page size of the model.
+        """
+        sql = self._is_sql_load(model_name, rs)
+        size = self._get_field_info_dict(model_name).get(
+            'create_batch_size', sql and self._get_page_size(model_name) or default_size)
+        if size <= 1 and not sql:
+            return None
+
+        def register(vals_list, records):
+            field_name = self._old_id_field(model_name)
+            for vals, record in zip(vals_list, records):
+                self._register_old_id(model_name, vals[field_name], record.id)
+
+        if sql:
+            return SqlCreateBatch(rs, size, self._old_id_field(model_name), on_create=register)
+        return CreateBatch(rs, size, on_create=register)
+
+    def _get_write_batch(self, model_name, rs):
+        """SqlWriteBatch with 'load_mode': 'sql' in the model config, otherwise WriteBatch"""
+        return self._is_sql_load(model_name, rs) and SqlWriteBatch(rs) or WriteBatch(rs)
+
+    def _handle_record(self, rs_model, key_fields, model_name, archived, create, record, batch=None):
+        """Return the local record matching the key_fields of record, create it if needed.
+        With a batch the creation is queued and None is returned.
+        """
+        key = self._record_key(record, key_fields)
+        # the matches of the page, loaded at once, see init_import_models
+        matcher = self._key_matchers.get(model_name)
+        if matcher and matcher.supports(key_fields):
+            candidates = matcher.match(key_fields, key)
+            match = rs_model.browse([local_id for local_id, _old_id in candidates])
+            x_old_id = candidates and candidates[0][1] or False
+        else:
+            candidates = None
+            domain = []
+            if 'active' in key_fields or archived:
+                domain = ['|', ('active', '=', False), ('active', '=', True)] or []
+            domain.extend([(f, '=', value) for f, value in zip(key_fields, key)])
+            if self.partition:
+                # another worker may be creating the same record
+                advisory_lock(self.env.cr, model_name, *key)
+            match = rs_model.search(domain)
+            x_old_id = len(match) == 1 and getattr(match, self._old_id_field(model_name))
         if len(match) > 1:
+            if matcher:
+                matcher.ambiguous[record['id']] = match.ids
             raise Exception('More than one match for the same x_old_id')
         if match:
-            x_old_id = getattr(match, 'x_%s_id' % model_name.replace('.', '_'))
             if x_old_id < 0 or not x_old_id:
-                setattr(match, 'x_%s_id' % model_name.replace('.', '_'), record['id'])
+                setattr(match, self._old_id_field(model_name), record['id'])
+                self._register_old_id(model_name, record['id'], match.id)
+                if candidates:
+                    matcher.set_old_id(key_fields, key, match.id, record['id'])
+            elif x_old_id != record['id']:
+                # matched a record imported from another remote id, or by another worker: the children
+                # of this one are linked to it too, see _iter_hierarchy
+                self._register_old_id(model_name, record['id'], match.id)
+                self._aliased.add(model_name)
             return match
         if create:
-            record['x_%s_id' % model_name.replace('.', '_')] = record['id']
-            record.pop('id', None)
+            old_id = record.pop('id', None)
+            record[self._old_id_field(model_name)] = old_id
+            if batch is not None:
+                # same key already queued: it would have matched the queued record
+                if batch.add(record, key=tuple(key)) and candidates is not None:
+                    matcher.queue(key_fields, key, old_id)
+                return None
             res = rs_model.create(record)
+            self._register_old_id(model_name, old_id, res.id)
+            if candidates is not None:
+                matcher.add(key_fields, key, res.id, old_id)
             return res
         else:
+            if matcher:
+                matcher.missing.add(record['id'])
             return False
 
+    def _record_key(self, record, key_fields):
+        # if key field is a "*_id" will return a <list>
+        return [record[f][0] if type(record[f]) is list else record[f] for f in key_fields]
+
     def init_import_models(self, model_name):
         """First check that things match and add the id of the origin to the new db
         This will also print records that don't match but sometimes doesn't matter
@@ -429,8 +1326,11 @@ class MigrateToolBase(object):
 
         :return:
         """
-        info = self._get_field_info_dict(model_name)
+        # the old id field is created before forking, once
         self.ensure_model(model_name)
+        if self._get_workers(model_name) > 1 and not self.partition:
+            return self._run_partitioned('init_import_models', model_name)
+        info = self._get_field_info_dict(model_name)
         domain_extra, required_fields, key_fields, include_archived, new_model_name, create_record, extra_args = \
             info['domain'], info['required_fields'], info['key_fields'], info['include_archived'], \
                 info['new_model_name'], info['create'], info['extra_args']
@@ -438,44 +1338,152 @@ class MigrateToolBase(object):
         transform_name = extra_args.get('transform', False)
         _logger.info('MIG: ... Initiate import model name: %s' % model_name)
         rs = self.env[new_model_name].with_context(**DISABLED_MAIL_CONTEXT)
-        remote_rs = self.connection.get_model(model_name)
         domain = []
         fields = key_fields
         if 'active' in self.target_fields:
             fields = fields + ['active']
             domain = include_archived and ['|', ('active', '=', False), ('active', '=', True)] or []
         domain.extend(domain_extra)
-        # exclude already imported
-        all_done = self.search_all(new_model_name, [('x_%s_id' % model_name.replace('.', '_'), '!=', False)])
-        domain.extend([('id', 'not in', all_done.mapped('x_%s_id' % model_name.replace('.', '_')))])
+        domain.extend(self._partition_domain())
+        hierarchical = 'parent_id' in fields + required_fields and \
+            self.get_model_metadata(model_name)['origin_fields']['parent_id']['relation'] == model_name
+        # children are imported after their parents, not in id order: a checkpoint would skip them.
+        # The last id done of a partition means nothing to the others, nor to the ranges of the next run.
+        checkpoint = self.checkpoint_store and not hierarchical and not self.partition and \
+            Checkpoint(self.checkpoint_store, model_name, 'init_import_models')
+        watermark = self._get_watermark(model_name, 'init_import_models')
+        if watermark and watermark.value:
+            # only what was written since the last run and what failed, the records already imported
+            # are skipped below
+            since = watermark.domain()
+            if checkpoint and checkpoint.failed_ids:
+                since = ['|', ('id', 'in', sorted(checkpoint.failed_ids))] + since
+            domain.extend(since)
+        elif checkpoint and checkpoint.exists:
+            # only what is after the checkpoint and what failed
+            domain.extend(checkpoint.domain())
+        else:
+            # exclude already imported
+            imported = self.get_id_map(model_name)
+            if self.partition:
+                imported = [old_id for old_id in imported if self.partition[0] <= old_id <= self.partition[1]]
+            domain.extend([('id', 'not in', list(imported))])
+        batch = self._get_create_batch(model_name, rs)
+        if batch and post_run_name:
+            register = batch.on_create
 
-        for rec in self.remote_search_all(
-                model_name, domain, fields=(fields + required_fields),  order="id", limit=self.test_mode and 100 or 0):
-            _logger.info('MIG: Importing record model %s: %s' % (new_model_name or model_name, rec_to_str(rec)))
+            def on_create(vals_list, records):
+                register(vals_list, records)
+                getattr(self, post_run_name)(list(records))
+
+            batch.on_create = on_create
+        # existing records are matched a page at a time, unless another worker may create them meanwhile
+        matcher = info.get('bulk_matching', True) and not self.partition and \
+            KeyMatcher(rs, self._old_id_field(model_name), include_archived)
+        if matcher:
+            self._key_matchers[model_name] = matcher
+            if batch:
+                on_batch_create = batch.on_create
+
+                def on_create(vals_list, records):
+                    on_batch_create(vals_list, records)
+                    matcher.created(vals_list, records)
+
+                batch.on_create = on_create
+
+        def transform(rec):
+            """Return the record as the transform hook changes it and its key fields"""
             if transform_name:
-                transform = getattr(self, transform_name)
-                rec, key_fields_target = transform(rec, key_fields)
-            else:
-                key_fields_target = key_fields
-            if rec.get('parent_id', False):
-                parent_id = rec.get('parent_id', False)[0]
-                # first create the parent
-                [parent_rec] = remote_rs.search_read([('id', '=', parent_id)], key_fields + required_fields)
-                parent_rec.pop('parent_id', None)
-                local_parent_id = self._handle_record(
-                    rs, key_fields_target, model_name, include_archived, create_record, parent_rec)
-                # then create the child
-                rec['parent_id'] = local_parent_id.id
-                local_id = self._handle_record(rs, key_fields_target, model_name, include_archived, create_record, rec)
-                records = [local_parent_id, local_id]
-            else:
-                rec = self._convert_id_records(model_name, rec)
-                res = self._handle_record(rs, key_fields_target, model_name, include_archived, create_record, rec)
-                records = [res]
+                return getattr(self, transform_name)(rec, key_fields)
+            return rec, key_fields
+
+        def key_of(rec):
+            # the hook runs once per record: process takes the transformed record back from the matcher
+            remote_id = rec['id']
+            rec, key_fields_target = transform(rec)
+            matcher.keep(remote_id, (dict(rec), key_fields_target))
+            rec = self._convert_id_records(model_name, dict(rec))
+            return tuple(key_fields_target), tuple(self._record_key(rec, key_fields_target))
 
+        def process(rec):
+            _logger.info('MIG: Importing record model %s: %s' % (new_model_name or model_name, rec_to_str(rec)))
+            prepared = matcher and matcher.take(rec['id'])
+            if prepared:
+                rec, key_fields_target = dict(prepared[0]), prepared[1]
+            else:
+                rec, key_fields_target = transform(rec)
+            # parent_id is already imported, see _iter_hierarchy
+            rec = self._convert_id_records(model_name, rec)
+            res = self._handle_record(
+                rs, key_fields_target, model_name, include_archived, create_record, rec, batch=batch)
+            if res is None:
+                # queued in batch, post_run is called when the batch is created
+                return
             if post_run_name:
                 post_run = getattr(self, post_run_name)
-                post_run(records)
+                post_run([res])
+
+        records = self.remote_iter_records(model_name, domain, fields=(fields + required_fields),
+                                           limit=self.test_mode and 100 or 0, include_archived=True)
+        if watermark and watermark.value:
+            imported = self.get_id_map(model_name)
+            records = (rec for rec in records if rec['id'] not in imported)
+        if matcher:
+            records = matcher.iter_primed(records, key_of, self._get_page_size(model_name))
+        if hierarchical:
+            records = self._iter_hierarchy(model_name, records, fields + required_fields)
+        try:
+            failed = self._run_batched('init_import_models', records, process, batches=batch and [batch] or [],
+                                       checkpoint=checkpoint)
+        finally:
+            if matcher:
+                del self._key_matchers[model_name]
+                matcher.report()
+            if model_name in self._aliased:
+                # not in the old id column: the next phases see the id map a new run would load
+                self._aliased.discard(model_name)
+                self.invalidate_id_maps(model_name)
+        # the checkpoint keeps the failed ids, they are read again whatever the watermark
+        self._save_watermark(watermark, not checkpoint and failed)
+
+    def _iter_hierarchy(self, model_name, records, fields):
+        """Yield the records of a parent_id hierarchy, each one after its parent is imported.
+        FLUSH_BATCHES is yielded at the end of each level, as the parents may be queued in a batch.
+
+        Records whose parent has no new id yet wait for it. Once all records went through, the waiting
+        records whose parent got imported follow, level by level. Parents that were not in records
+        (outside the domain) are fetched in pages and go first. Every remote record is fetched once.
+        """
+        waiting, seen = {}, set()
+        level = records
+        while True:
+            for rec in level:
+                seen.add(rec['id'])
+                parent_id = rec.get('parent_id') and rec['parent_id'][0]
+                if parent_id and parent_id != rec['id'] and not self.map_old_id(model_name, parent_id):
+                    waiting.setdefault(parent_id, []).append(rec)
+                    continue
+                yield rec
+            if not waiting:
+                return
+            yield FLUSH_BATCHES
+            ready = [parent_id for parent_id in waiting if self.map_old_id(model_name, parent_id)]
+            missing = [parent_id for parent_id in waiting if parent_id not in seen]
+            if ready:
+                level = [rec for parent_id in ready for rec in waiting.pop(parent_id)]
+            elif missing:
+                _logger.info('MIG: ... fetching %s parents of %s' % (len(missing), model_name))
+                # fetched once, even if they don't exist anymore
+                seen.update(missing)
+                page_size = self._get_page_size(model_name)
+                level = (rec for start in range(0, len(missing), page_size) for rec in self.remote_search_all(
+                    model_name, [('id', 'in', missing[start:start + page_size])], fields))
+            else:
+                # parents that could not be imported, or a loop in the data
+                level = [rec for recs in waiting.values() for rec in recs]
+                _logger.warning('MIG: ... %s %s records imported without their parent' % (len(level), model_name))
+                yield from level
+                return
 
     def print_diff(self, model_name):
         self.ensure_model(model_name)
@@ -0,0 +1,141 @@
+import zlib
+import queue
+import logging
+import traceback
+import multiprocessing
+
+from odoolib.main import JsonRPCException
+
+_logger = logging.getLogger(__name__)
+
+# database pools and cursors inherited from the coordinator: a forked worker must never close them,
+# it would close the connections of the coordinator. Kept here so they are never garbage collected.
+_inherited = []
+
+
+def split_id_range(remote_rs, domain, partitions, probes=4):
+    """Split the remote ids matching domain into at most `partitions` contiguous (first id, last id)
+    ranges holding about the same number of records. The id range is cut in partitions * probes
+    slices whose records are counted, then the slices are grouped.
+    """
+    first = remote_rs.search(domain, 0, 1, 'id')
+    if not first:
+        return []
+    last = remote_rs.search(domain, 0, 1, 'id desc')
+    low, high = first[0], last[0]
+    step = max(-(-(high - low + 1) // (partitions * probes)), 1)
+    slices = []
+    for start in range(low, high + 1, step):
+        end = min(start + step - 1, high)
+        slices.append((start, end, remote_rs.search_count(domain + [('id', '>=', start), ('id', '<=', end)])))
+    target = sum(count for _start, _end, count in slices) / partitions
+    ranges, start, count = [], low, 0
+    for slice_start, slice_end, slice_count in slices:
+        count += slice_count
+        if count >= target * (len(ranges) + 1) and len(ranges) < partitions - 1:
+            ranges.append((start, slice_end))
+            start = slice_end + 1
+    if start <= high:
+        ranges.append((start, high))
+    return ranges
+
+
+def advisory_lock(cr, *key):
+    """Lock key until the end of the transaction, other workers locking the same key wait for it"""
+    cr.execute('SELECT pg_advisory_xact_lock(%s)', [zlib.crc32(repr(key).encode())])
+
+
+def _detach_database(tool):
+    """Give the forked worker its own connection pool, cursor and environment"""
+    from odoo import api, sql_db
+    env = tool.env
+    registry = env.registry
+    _inherited.append((sql_db._Pool, registry._db, env.cr))
+    sql_db._Pool = None
+    registry._db = sql_db.db_connect(registry.db_name)
+    tool.env = api.Environment(registry.cursor(), env.uid, env.context)
+
+
+def _run_job(tool, index, method_name, model_name, args, kwargs, id_range, results):
+    _detach_database(tool)
+    # the threads of the coordinator's prefetch pipelines don't exist in the fork
+    tool._prefetch = {}
+    # sent back to the coordinator at the end
+    tool.metrics = tool.metrics.for_worker()
+    tool.partition = id_range
+    tool.progress_callback = lambda phase, done_ids, failed_ids: results.put(
+        ('progress', index, len(done_ids), list(failed_ids)))
+    try:
+        if tool.checkpoint_store:
+            # stores are bound to the coordinator's cursor or file
+            tool.checkpoint_store = tool.checkpoint_store.reopen(tool.env)
+        getattr(tool, method_name)(model_name, *args, **kwargs)
+        result = ('done', index, None, None)
+    except Exception:
+        tool.env.cr.rollback()
+        result = ('error', index, None, traceback.format_exc())
+    finally:
+        tool.env.cr.close()
+    results.put(('metrics', index, None, tool.metrics.stats))
+    results.put(result)
+
+
+def run_forked(tool, jobs):
+    """Run each job, (method name, model name, args, kwargs, id range or None), in a forked process
+    calling tool.<method name>(model name, *args, **kwargs), and wait for them.
+
+    Returns {'done': records done, 'failed': remote ids skipped, 'errors': {job index: traceback}}
+    """
+    # the workers start from what is committed
+    tool.commit()
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = {}
+    for index, (method_name, model_name, args, kwargs, id_range) in enumerate(jobs):
+        processes[index] = context.Process(
+            target=_run_job, name='cemigrate-%s-%s' % (model_name, index),
+            args=(tool, index, method_name, model_name, args, kwargs or {}, id_range, results))
+        processes[index].start()
+    done, failed, errors, running = 0, [], {}, set(processes)
+    while running:
+        try:
+            kind, index, count, data = results.get(timeout=1)
+        except queue.Empty:
+            for index in list(running):
+                if not processes[index].is_alive() and results.empty():
+                    running.discard(index)
+                    errors[index] = 'worker exited with code %s' % processes[index].exitcode
+            continue
+        method_name, model_name = jobs[index][:2]
+        if kind == 'progress':
+            done += count
+            failed.extend(data)
+            _logger.info('MIG: ... %s %s: %s records done' % (method_name, model_name, done))
+        elif kind == 'metrics':
+            tool.metrics.merge(data)
+        else:
+            running.discard(index)
+            if kind == 'error':
+                errors[index] = data
+                _logger.error('MIG: ... %s %s in process %s failed:\n%s' % (method_name, model_name, index, data))
+    for process in processes.values():
+        process.join()
+    # the workers created records and old ids behind our back
+    for model_name in set(job[1] for job in jobs):
+        tool.invalidate_id_maps(model_name)
+    tool.env.invalidate_all()
+    return {'done': done, 'failed': failed, 'errors': errors}
+
+
+def run_partitioned(tool, method_name, model_name, workers, args=(), kwargs=None):
+    """Run tool.<method_name>(model_name, ...) in `workers` forked processes, each on its own range
+    of remote ids, and wait for them. Returns the result of run_forked.
+    """
+    remote_rs = tool.connection.get_model(model_name)
+    try:
+        ranges = split_id_range(remote_rs, ['|', ('active', '=', False), ('active', '=', True)], workers)
+    except JsonRPCException:
+        ranges = split_id_range(remote_rs, [], workers)
+    for index, id_range in enumerate(ranges):
+        _logger.info('MIG: ... %s %s partition %s: ids %s to %s' % (method_name, model_name, index, *id_range))
+    return run_forked(tool, [(method_name, model_name, args, kwargs, id_range) for id_range in ranges])
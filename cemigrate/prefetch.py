@@ -0,0 +1,117 @@
+import queue
+import logging
+import threading
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+from odoolib import Connection
+from odoolib.main import JsonRPCException
+
+_logger = logging.getLogger(__name__)
+
+
+def clone_connection(connection):
+    """New odoolib connection to the same server and database, with its own connector"""
+    if hasattr(connection, 'clone'):
+        # wrappers like SnapshotConnection clone themselves
+        return connection.clone()
+    connector = connection.connector
+    if hasattr(connector, 'clone'):
+        connector = connector.clone()
+    else:
+        url = urlsplit(connector.url)
+        connector = type(connector)(url.hostname, url.port)
+    return Connection(connector, connection.database, connection.login, connection.password, connection.user_id)
+
+
+class PrefetchPipeline(object):
+    """Fetch the pages of remote records ahead of the consumer.
+
+    A feeder thread searches the ids page after page (keyset pagination, only ids travel) and
+    hands every page to a pool of `workers` threads that read the records, each with its own
+    connection. At most `depth` pages are fetched or waiting to be consumed, which bounds the
+    memory used while the main thread writes in the local database.
+
+    The threads and their connections are kept from one call of iter_pages to the next, close() stops them.
+    """
+
+    def __init__(self, connection, workers=4, depth=8):
+        self.connection = connection
+        self.workers = workers
+        self.depth = max(depth, workers)
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='cemigrate-prefetch')
+        # connections of the feeders, one per iter_pages running at the same time
+        self.feed_connections = []
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def get_model(self, model_name):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = clone_connection(self.connection)
+        return self.local.connection.get_model(model_name)
+
+    def _read(self, model_name, ids, fields):
+        page = self.get_model(model_name).read(ids, fields or [])
+        page.sort(key=lambda rec: rec['id'])
+        return page
+
+    def _feed(self, pending, stop, connection, model_name, domain, domain_active, fields, page_size, limit):
+        try:
+            last_id, count = 0, 0
+            while not stop.is_set():
+                size = limit and min(page_size, limit - count) or page_size
+                try:
+                    ids = connection.get_model(model_name).search(domain_active + domain + [('id', '>', last_id)],
+                                                                  0, size, 'id')
+                except JsonRPCException:
+                    if not domain_active:
+                        raise
+                    # if "Invalid field op.project.active in leaf ('active', '=', True)"
+                    domain_active = []
+                    continue
+                if ids:
+                    count += len(ids)
+                    last_id = ids[-1]
+                    pending.put(self.executor.submit(self._read, model_name, ids, fields))
+                if len(ids) < size or (limit and count >= limit):
+                    break
+        except Exception as e:
+            pending.put(e)
+        pending.put(None)
+
+    def iter_pages(self, model_name, domain, fields, page_size, limit=None, domain_active=None):
+        """Yield the pages of records, ordered by id, as remote_iter_pages does"""
+        # the feeder blocks on put() while `depth` pages are pending
+        pending = queue.Queue(self.depth)
+        stop = threading.Event()
+        with self.lock:
+            connection = self.feed_connections.pop() if self.feed_connections else None
+        connection = connection or clone_connection(self.connection)
+        feeder = threading.Thread(target=self._feed, daemon=True, args=(
+            pending, stop, connection, model_name, list(domain), list(domain_active or []), fields, page_size,
+            limit))
+        feeder.start()
+        try:
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item.result()
+        finally:
+            stop.set()
+            # unblock the feeder and drop what was prefetched for nothing
+            while feeder.is_alive() or not pending.empty():
+                try:
+                    item = pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is not None and not isinstance(item, Exception):
+                    item.cancel()
+            feeder.join()
+            with self.lock:
+                self.feed_connections.append(connection)
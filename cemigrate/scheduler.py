@@ -0,0 +1,226 @@
+import logging
+
+from .migrate_tool import MigrationError
+from .partition import run_forked
+
+_logger = logging.getLogger(__name__)
+
+INIT = 'init_import_models'
+BASIC = 'import_basic_types'
+MANY2ONE = 'update_many2one_fields'
+MANY2MANY = 'update_many2many_fields'
+CHATTER = 'copy_chatter'
+ATTACHMENTS = 'copy_attachments'
+DEFAULT_PHASES = (INIT, MANY2ONE, MANY2MANY)
+
+
+def _strongly_connected(graph):
+    """Tarjan's algorithm, graph is {node: set of nodes}. Returns the list of components (sets)."""
+    index, low, stack, on_stack, components = {}, {}, [], set(), []
+
+    def visit(node):
+        index[node] = low[node] = len(index)
+        stack.append(node)
+        on_stack.add(node)
+        for succ in graph[node]:
+            if succ not in index:
+                visit(succ)
+                low[node] = min(low[node], low[succ])
+            elif succ in on_stack:
+                low[node] = min(low[node], index[succ])
+        if low[node] == index[node]:
+            component = set()
+            while True:
+                succ = stack.pop()
+                on_stack.discard(succ)
+                component.add(succ)
+                if succ == node:
+                    break
+            components.append(component)
+
+    for node in graph:
+        if node not in index:
+            visit(node)
+    return components
+
+
+class MigrationPlan(object):
+    """Phases of the models of the config ordered by their relations.
+
+    A model is created (init_import_models) after the models its key and required many2one
+    fields point to, and its relational fields are updated once the related models exist.
+    Creation cycles, e.g. partner <-> user, are broken by deferring the fewest and cheapest fields,
+    preferably neither key fields nor fields required on the new model: they are mapped to False at
+    creation and set by the update_many2one_fields step. Fields pointing to their own model, e.g.
+    parent_id, are left to the hierarchy import of init_import_models.
+
+    Per model, these config keys are read:
+        phases: phases to run, by default init_import_models, update_many2one_fields and
+            update_many2many_fields. import_basic_types and copy_chatter can be added.
+        force_fields: force_fields of import_basic_types
+        many2one_fields / many2many_fields: fields updated, by default all the matching ones
+            pointing to a model of the config
+    """
+
+    def __init__(self, tool, models=None):
+        self.tool = tool
+        if not tool.MODEL_INFO:
+            tool._get_model_info_dict()
+        self.models = list(models or tool.MODEL_INFO)
+        # {step: set of steps to run before}, a step is (phase, model name)
+        self.requires = {}
+        # {model name: fields set by update_many2one_fields although needed at creation}
+        self.deferred = {}
+        self._build()
+
+    def _relational_fields(self, model_name, ttype):
+        """The fields of type ttype updated by the plan"""
+        info = self.tool.MODEL_INFO[model_name]
+        if '%s_fields' % ttype in info:
+            return list(info['%s_fields' % ttype])
+        meta = self.tool.get_model_metadata(model_name)
+        diff = meta['diff']
+        return [field_name for field_name in meta['matching_fields']
+                if diff[field_name]['origin'] == ttype and diff[field_name]['target'] == ttype and
+                meta['origin_fields'][field_name]['relation'] in self.models]
+
+    def _field_cost(self, model_name, field_name):
+        """Cost of creating the records of model_name without field_name: key fields are needed to match
+        the existing records, fields required on the new model to create them"""
+        info = self.tool.MODEL_INFO[model_name]
+        if field_name in info['key_fields']:
+            return 4
+        field = self.tool.env[self.tool._get_new_model(model_name)]._fields.get(field_name)
+        return field is not None and field.required and 2 or 1
+
+    def _feedback_edges(self, graph, created_with, cycles):
+        """Edges (model name, related model) to remove from graph so that it has no cycle, the cheapest first.
+        Edges are removed one at a time until the cycles are broken, then the ones not needed anymore are
+        put back.
+        """
+        cost = {(m, r): sum(self._field_cost(m, f) for f, rel in created_with[m].items() if rel == r)
+                for component in cycles for m in component for r in graph[m] if r in component}
+        graph = {m: set(rels) for m, rels in graph.items()}
+        removed = []
+        while cycles:
+            component = cycles[0]
+            edge = min(((m, r) for m in component for r in graph[m] if r in component),
+                       key=lambda e: (cost[e], -self.models.index(e[0]), e))
+            graph[edge[0]].discard(edge[1])
+            removed.append(edge)
+            cycles = [c for c in _strongly_connected(graph) if len(c) > 1]
+        for edge in sorted(removed, key=lambda e: -cost[e]):
+            graph[edge[0]].add(edge[1])
+            if any(len(c) > 1 for c in _strongly_connected(graph)):
+                graph[edge[0]].discard(edge[1])
+            else:
+                removed.remove(edge)
+        return removed
+
+    def _build(self):
+        model_info = self.tool.MODEL_INFO
+        phases = {m: model_info[m].get('phases', DEFAULT_PHASES) for m in self.models}
+        many2one = {m: self._relational_fields(m, 'many2one') for m in self.models}
+        many2many = {m: self._relational_fields(m, 'many2many') for m in self.models}
+
+        def relation(model_name, field_name):
+            return self.tool.get_model_metadata(model_name)['origin_fields'][field_name]['relation']
+
+        # creation dependencies: the many2one fields converted by init_import_models
+        created_with = {}
+        for model_name in self.models:
+            info = model_info[model_name]
+            origin_fields = self.tool.get_model_metadata(model_name)['origin_fields']
+            created_with[model_name] = {
+                f: relation(model_name, f) for f in info['key_fields'] + info.get('required_fields', [])
+                if f != 'id' and origin_fields.get(f, {}).get('type') == 'many2one' and
+                relation(model_name, f) in self.models}
+        # a model pointing to itself, e.g. parent_id, is imported as a hierarchy by init_import_models
+        graph = {m: set(r for f, r in created_with[m].items() if r != m) for m in self.models}
+        cycles = [component for component in _strongly_connected(graph) if len(component) > 1]
+        for component in cycles:
+            _logger.warning('MIG: ... creation cycle between %s' % ', '.join(sorted(component)))
+        for model_name, rel in self._feedback_edges(graph, created_with, cycles):
+            graph[model_name].discard(rel)
+            self.deferred.setdefault(model_name, []).extend(
+                f for f, r in created_with[model_name].items() if r == rel)
+        for model_name, fields in self.deferred.items():
+            for field_name in fields:
+                if field_name not in many2one[model_name]:
+                    many2one[model_name].append(field_name)
+            if MANY2ONE not in phases[model_name]:
+                phases[model_name] = tuple(phases[model_name]) + (MANY2ONE,)
+
+        def created(model_name):
+            """steps after which the records of model_name exist"""
+            return {(p, model_name) for p in (INIT, BASIC) if p in phases.get(model_name, ())}
+
+        for model_name in self.models:
+            model_phases = phases[model_name]
+            if INIT in model_phases:
+                self.requires[(INIT, model_name)] = set().union(*[created(r) for r in graph[model_name]])
+            if BASIC in model_phases:
+                self.requires[(BASIC, model_name)] = {(INIT, model_name)} & set(self.requires)
+            for phase, fields in ((MANY2ONE, many2one[model_name]), (MANY2MANY, many2many[model_name])):
+                if phase in model_phases and fields:
+                    self.requires[(phase, model_name)] = created(model_name).union(
+                        *[created(relation(model_name, f)) for f in fields])
+            if (MANY2ONE, model_name) in self.requires and (MANY2MANY, model_name) in self.requires:
+                # both write the same rows, never in parallel
+                self.requires[(MANY2MANY, model_name)].add((MANY2ONE, model_name))
+            if CHATTER in model_phases:
+                self.requires[(CHATTER, model_name)] = created(model_name) | created('res.partner')
+            if ATTACHMENTS in model_phases:
+                self.requires[(ATTACHMENTS, model_name)] = created(model_name)
+        self.many2one = many2one
+        self.many2many = many2many
+
+    def waves(self):
+        """Lists of steps, each step only requires steps of the previous lists"""
+        done, waves = set(), []
+        left = dict(self.requires)
+        while left:
+            wave = sorted((step for step, before in left.items() if before <= done),
+                          key=lambda step: (self.models.index(step[1]), step[0]))
+            if not wave:
+                raise MigrationError('Dependency cycle between %s' % sorted(left))
+            waves.append(wave)
+            done.update(wave)
+            for step in wave:
+                del left[step]
+        return waves
+
+    def _call(self, step):
+        phase, model_name = step
+        info = self.tool.MODEL_INFO[model_name]
+        if phase == BASIC:
+            return (info.get('force_fields', []),)
+        if phase == MANY2ONE:
+            return (self.many2one[model_name],)
+        if phase == MANY2MANY:
+            return (self.many2many[model_name],)
+        return ()
+
+    def print_plan(self):
+        for number, wave in enumerate(self.waves(), 1):
+            print('wave %s:' % number)
+            for step in wave:
+                print('    %s(%r%s)' % (step[0], step[1], ''.join(', %r' % arg for arg in self._call(step))))
+
+    def run(self, workers=1):
+        """Run the steps wave after wave. With workers > 1, up to `workers` steps of a wave run at
+        the same time, each in a forked process.
+        """
+        for number, wave in enumerate(self.waves(), 1):
+            _logger.info('MIG: ... wave %s: %s' % (number, ', '.join('%s %s' % step for step in wave)))
+            if workers <= 1 or len(wave) == 1:
+                for step in wave:
+                    getattr(self.tool, step[0])(step[1], *self._call(step))
+                continue
+            for start in range(0, len(wave), workers):
+                steps = wave[start:start + workers]
+                res = run_forked(self.tool, [(phase, model_name, self._call((phase, model_name)), None, None)
+                                             for phase, model_name in steps])
+                if res['errors']:
+                    raise MigrationError('Wave %s failed: %s' % (number, ', '.join(
+                        '%s %s' % steps[index] for index in sorted(res['errors']))))
@@ -0,0 +1,245 @@
+import os
+import json
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from odoolib.main import JsonRPCException
+
+_logger = logging.getLogger(__name__)
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _pack(value):
+    return zlib.compress(json.dumps(value).encode())
+
+
+def _unpack(blob):
+    return json.loads(zlib.decompress(blob).decode())
+
+
+class SnapshotConnection(object):
+    """odoolib connection keeping what it fetched in a local SQLite file, replayed on the next runs.
+
+    The results of search and search_count are kept per model, domain, offset, limit, order and context,
+    which with keyset pagination means per id range. The records read are kept per model and id, a read
+    is answered locally when all its fields are known. Everything else goes to the server.
+
+    With refresh='write_date', searches always go to the server (only ids travel) and the records
+    written on the server since they were fetched, minus `overlap` seconds, are fetched again. Without
+    it, the snapshot is replayed as is until invalidate() is called.
+    """
+
+    def __init__(self, connection, path, refresh=None, overlap=60):
+        if refresh not in (None, 'write_date'):
+            raise ValueError("refresh must be None or 'write_date', not %r" % refresh)
+        self.connection = connection
+        self.path = os.path.expanduser(path)
+        self.refresh = refresh
+        self.overlap = overlap
+        self.local = threading.local()
+        # models checked for changes on the server by this connection, in refresh mode
+        self.refreshed = set()
+        self.hits = 0
+        self.misses = 0
+        db = self.db
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS query (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                result BLOB NOT NULL)""")
+        db.execute('CREATE INDEX IF NOT EXISTS query_model ON query (model)')
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS record (
+                model TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (model, id))""")
+        # latest remote write_date of the model when its records were first fetched or last refreshed
+        db.execute("""
+            CREATE TABLE IF NOT EXISTS synced (
+                model TEXT PRIMARY KEY,
+                write_date TEXT)""")
+        db.commit()
+
+    def __getattr__(self, name):
+        # database, login, password, user_id, connector... of the wrapped connection
+        return getattr(self.connection, name)
+
+    @property
+    def db(self):
+        """SQLite connection of the current thread and process"""
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.pid = os.getpid()
+            self.local.db = sqlite3.connect(self.path, timeout=60)
+            self.local.db.execute('PRAGMA journal_mode=WAL')
+        return self.local.db
+
+    def clone(self):
+        """Same snapshot over a new connection to the server, for other threads"""
+        from .prefetch import clone_connection
+        clone = SnapshotConnection(clone_connection(self.connection), self.path, self.refresh, self.overlap)
+        clone.refreshed = self.refreshed
+        return clone
+
+    def get_model(self, model_name):
+        return SnapshotModel(self, model_name)
+
+    def invalidate(self, model_name=None):
+        """Forget what was fetched for model_name, or for all the models"""
+        db = self.db
+        for table in ('query', 'record', 'synced'):
+            db.execute('DELETE FROM %s WHERE ? IS NULL OR model = ?' % table, (model_name, model_name))
+        db.commit()
+        if model_name:
+            self.refreshed.discard(model_name)
+        else:
+            self.refreshed.clear()
+
+    # ------------------------------------------------------------------ storage
+    def get_query(self, key):
+        row = self.db.execute('SELECT result FROM query WHERE key = ?', (key,)).fetchone()
+        return row and _unpack(row[0])
+
+    def save_query(self, key, model_name, result):
+        self.db.execute('INSERT OR REPLACE INTO query (key, model, result) VALUES (?, ?, ?)',
+                        (key, model_name, _pack(result)))
+        self.db.commit()
+
+    def get_records(self, model_name, ids):
+        res = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            res.update((record_id, _unpack(data)) for record_id, data in self.db.execute(
+                'SELECT id, data FROM record WHERE model = ? AND id IN (%s)' % ','.join('?' * len(chunk)),
+                [model_name] + chunk))
+        return res
+
+    def save_records(self, model_name, records):
+        self.db.executemany('INSERT OR REPLACE INTO record (model, id, data) VALUES (?, ?, ?)',
+                            [(model_name, rec['id'], _pack(rec)) for rec in records])
+        self.db.commit()
+
+    def get_synced(self, model_name):
+        row = self.db.execute('SELECT write_date FROM synced WHERE model = ?', (model_name,)).fetchone()
+        return row and (row[0] or '')
+
+    def save_synced(self, model_name, write_date):
+        self.db.execute('INSERT OR REPLACE INTO synced (model, write_date) VALUES (?, ?)', (model_name, write_date))
+        self.db.commit()
+
+    # ------------------------------------------------------------------ write_date
+    def _latest_write_date(self, model_name):
+        """Latest write_date on the server, '' when the model has none"""
+        remote_rs = self.connection.get_model(model_name)
+        try:
+            ids = remote_rs.search([], 0, 1, 'write_date desc', context={'active_test': False})
+            return ids and remote_rs.read(ids, ['write_date'])[0]['write_date'] or ''
+        except JsonRPCException:
+            return ''
+
+    def ensure_synced(self, model_name):
+        """Called before fetching records: remember from when the snapshot of the model dates"""
+        if self.get_synced(model_name) is None:
+            self.save_synced(model_name, self._latest_write_date(model_name))
+
+    def refresh_model(self, model_name):
+        """Forget the records written on the server since the model was synced, once per connection"""
+        if model_name in self.refreshed:
+            return
+        self.refreshed.add(model_name)
+        synced = self.get_synced(model_name)
+        if synced is None:
+            return
+        latest = self._latest_write_date(model_name)
+        if not synced or not latest:
+            _logger.info('MIG: ... snapshot: no write_date for %s, fetching it again' % model_name)
+            self.invalidate(model_name)
+            self.refreshed.add(model_name)
+            return
+        since = datetime.strptime(synced[:19], DATE_FORMAT) - timedelta(seconds=self.overlap)
+        stale = self.connection.get_model(model_name).search(
+            [('write_date', '>', since.strftime(DATE_FORMAT))], context={'active_test': False})
+        db = self.db
+        for start in range(0, len(stale), 500):
+            chunk = stale[start:start + 500]
+            db.execute('DELETE FROM record WHERE model = ? AND id IN (%s)' % ','.join('?' * len(chunk)),
+                       [model_name] + chunk)
+        db.execute('UPDATE synced SET write_date = ? WHERE model = ?', (latest, model_name))
+        db.commit()
+        _logger.info('MIG: ... snapshot: %s %s records written since %s' % (len(stale), model_name, synced))
+
+
+class SnapshotModel(object):
+    """Remote model of a SnapshotConnection"""
+
+    def __init__(self, snapshot, model_name):
+        self.snapshot = snapshot
+        self.model_name = model_name
+        self.remote = snapshot.connection.get_model(model_name)
+
+    def __getattr__(self, method):
+        # writes and the other methods are not kept
+        return getattr(self.remote, method)
+
+    def _query(self, method, args, kwargs):
+        snapshot = self.snapshot
+        key = hashlib.sha1(json.dumps([self.model_name, method, args, kwargs], sort_keys=True,
+                                      default=list).encode()).hexdigest()
+        if not snapshot.refresh:
+            res = snapshot.get_query(key)
+            if res is not None:
+                snapshot.hits += 1
+                return res
+        snapshot.misses += 1
+        res = getattr(self.remote, method)(*args, **kwargs)
+        snapshot.save_query(key, self.model_name, res)
+        return res
+
+    def search(self, domain=None, offset=0, limit=None, order=None, context=None):
+        return self._query('search', [domain or [], offset or 0, limit or False, order or False],
+                           {'context': context or {}})
+
+    def search_count(self, domain=None, context=None):
+        return self._query('search_count', [domain or []], {'context': context or {}})
+
+    def read(self, ids, fields=None, context=None):
+        snapshot = self.snapshot
+        if isinstance(ids, int):
+            res = self.read([ids], fields, context)
+            return res and res[0] or False
+        if snapshot.refresh:
+            snapshot.refresh_model(self.model_name)
+        fields = list(fields or [])
+        cached = snapshot.get_records(self.model_name, list(ids))
+        res, missing = {}, []
+        for record_id in ids:
+            rec = cached.get(record_id)
+            if rec is not None and (rec.get('__all__') if not fields else all(f in rec for f in fields)):
+                res[record_id] = {f: rec[f] for f in fields} if fields else {
+                    f: v for f, v in rec.items() if f != '__all__'}
+                res[record_id]['id'] = record_id
+            else:
+                missing.append(record_id)
+        snapshot.hits += len(ids) - len(missing)
+        if missing:
+            snapshot.misses += len(missing)
+            snapshot.ensure_synced(self.model_name)
+            fetched = self.remote.read(missing, fields, context=context or {})
+            merged = []
+            for rec in fetched:
+                res[rec['id']] = dict(rec)
+                known = cached.get(rec['id']) or {}
+                merged.append(dict(known, **rec, __all__=not fields or known.get('__all__', False)))
+            snapshot.save_records(self.model_name, merged)
+        return [res[record_id] for record_id in ids if record_id in res]
+
+    def search_read(self, domain=None, fields=None, offset=0, limit=None, order=None, context=None):
+        ids = self.search(domain or [], offset, limit or False, order or False, context=context or {})
+        if not ids:
+            return []
+        return self.read(ids, fields or [], context=context or {})
@@ -0,0 +1,157 @@
+import json
+import logging
+
+from .batch import CreateBatch, WriteBatch
+
+_logger = logging.getLogger(__name__)
+
+# language of the values read on the old server, the key they get in the translated jsonb columns
+SOURCE_LANG = 'en_US'
+# columns filled by the loader, as the ORM does
+LOG_COLUMNS = ('create_uid', 'create_date', 'write_uid', 'write_date')
+NOW = "(now() at time zone 'UTC')"
+
+
+def sql_columns(rs):
+    """{field name: field} of the fields of rs stored in a column of its own table"""
+    return {name: field for name, field in rs._fields.items()
+            if name != 'id' and field.store and field.column_type and not field.inherited}
+
+
+def _to_column(field, value):
+    """ORM value of field as a query parameter"""
+    if field.type == 'boolean':
+        return bool(value)
+    if value is False or value is None:
+        return None
+    if field.type == 'many2one' and not isinstance(value, int):
+        raise ValueError('%s: %r is not a new id' % (field, value))
+    if field.translate:
+        return json.dumps({SOURCE_LANG: value})
+    return value
+
+
+def _check_columns(columns, names, rs):
+    unknown = sorted(set(names) - set(columns))
+    if unknown:
+        raise ValueError('%s are not columns of %s, they need the ORM' % (', '.join(unknown), rs._name))
+
+
+class SqlCreateBatch(CreateBatch):
+    """CreateBatch inserting the records with a multi-row INSERT instead of create().
+
+    Only the columns of the table are set: the vals, the defaults of the model (computed once, the same for
+    all the records) and the log columns. Translated fields get {SOURCE_LANG: value}. The stored computed
+    fields are marked to recompute, the ORM computes them at the next flush. Constraints in python, create
+    overrides, html sanitizing and tracking are skipped. Rows conflicting with a unique constraint are
+    skipped and logged. old_id_field tells which created record comes from which vals.
+    """
+
+    def __init__(self, rs, size, old_id_field, on_create=None):
+        super().__init__(rs, size, on_create=on_create)
+        self.old_id_field = old_id_field
+        self.columns = sql_columns(rs)
+        self.defaults = None
+
+    def _get_defaults(self):
+        if self.defaults is None:
+            names = [name for name, field in self.columns.items()
+                     if name not in LOG_COLUMNS and name != 'parent_path' and not field.compute]
+            self.defaults = {name: value for name, value in self.rs.default_get(names).items()
+                             if name in self.columns}
+        return self.defaults
+
+    def flush(self):
+        if not self.pending:
+            return self.rs.browse()
+        vals_list = self.pending
+        self.clear()
+        rs, env = self.rs, self.rs.env
+        env.flush_all()
+        defaults = self._get_defaults()
+        names = sorted(set(defaults).union(*vals_list) - set(LOG_COLUMNS))
+        _check_columns(self.columns, names, rs)
+        fields = [self.columns[name] for name in names]
+        row, log_params = ', '.join(field.translate and '%s::jsonb' or '%s' for field in fields), []
+        if rs._log_access:
+            # in the order of LOG_COLUMNS: the uids as parameters, the dates computed by the database
+            row += ''.join(name.endswith('_uid') and ', %s' or ', ' + NOW for name in LOG_COLUMNS)
+            log_params = [env.uid for name in LOG_COLUMNS if name.endswith('_uid')]
+        params = []
+        for vals in vals_list:
+            params.extend(_to_column(field, vals[name] if name in vals else defaults.get(name))
+                          for name, field in zip(names, fields))
+            params.extend(log_params)
+        env.cr.execute('INSERT INTO "%s" (%s) VALUES %s ON CONFLICT DO NOTHING RETURNING id, "%s"' % (
+            rs._table, ', '.join('"%s"' % name for name in names + (log_params and list(LOG_COLUMNS) or [])),
+            ', '.join(['(%s)' % row] * len(vals_list)), self.old_id_field), params)
+        new_ids = {old_id: new_id for new_id, old_id in env.cr.fetchall()}
+        created = [vals for vals in vals_list if vals.get(self.old_id_field) in new_ids]
+        if len(created) < len(vals_list):
+            _logger.warning('MIG: ... %s %s records conflict with existing records, not created: old ids %s' % (
+                len(vals_list) - len(created), rs._name,
+                [vals.get(self.old_id_field) for vals in vals_list if vals.get(self.old_id_field) not in new_ids][:10]))
+        records = rs.browse([new_ids[vals[self.old_id_field]] for vals in created])
+        env.invalidate_all()
+        if rs._parent_store:
+            records._parent_store_create()
+        for field in rs._fields.values():
+            if field.compute and field.store and field.name not in names:
+                env.add_to_compute(field, records)
+        records.modified(names, create=True)
+        _logger.info('MIG: ... inserted %s %s records' % (len(records), rs._name))
+        if self.on_create:
+            self.on_create(created, records)
+        return records
+
+
+class SqlWriteBatch(WriteBatch):
+    """WriteBatch updating the records with one UPDATE ... FROM (VALUES ...) per set of fields.
+
+    Rows already holding the values are left alone. Translated fields only get their SOURCE_LANG value
+    replaced. The fields depending on the ones written are marked to recompute, as with write().
+    """
+
+    def __init__(self, rs, size=None):
+        super().__init__(rs, size)
+        self.columns = sql_columns(rs)
+
+    def flush(self):
+        groups = self.groups
+        self.clear()
+        # {field names: [(record id, vals)]}
+        rows = {}
+        for vals, ids in groups.values():
+            for record_id in ids:
+                rows.setdefault(tuple(sorted(vals)), []).append((record_id, vals))
+        if not rows:
+            return
+        rs, env = self.rs, self.rs.env
+        env.flush_all()
+        updated = 0
+        for names, records_vals in rows.items():
+            _check_columns(self.columns, names, rs)
+            fields = [self.columns[name] for name in names]
+            row = ', '.join(['%s::int4'] + ['%%s::%s' % field.column_type[0] for field in fields])
+            params = []
+            for record_id, vals in records_vals:
+                params.append(record_id)
+                params.extend(_to_column(field, vals[name]) for name, field in zip(names, fields))
+            assignments = [
+                field.translate and '"%s" = COALESCE(t."%s", \'{}\'::jsonb) || v."%s"' % (name, name, name)
+                or '"%s" = v."%s"' % (name, name) for name, field in zip(names, fields)]
+            changes = [
+                field.translate and "t.\"%s\"->>'%s' IS DISTINCT FROM v.\"%s\"->>'%s'" % (
+                    name, SOURCE_LANG, name, SOURCE_LANG)
+                or 't."%s" IS DISTINCT FROM v."%s"' % (name, name) for name, field in zip(names, fields)]
+            if rs._log_access:
+                assignments += ['"write_uid" = %d' % env.uid, '"write_date" = ' + NOW]
+            env.cr.execute('UPDATE "%s" t SET %s FROM (VALUES %s) AS v(id, %s) WHERE t.id = v.id AND (%s) '
+                           'RETURNING t.id' % (
+                               rs._table, ', '.join(assignments), ', '.join(['(%s)' % row] * len(records_vals)),
+                               ', '.join('"%s"' % name for name in names), ' OR '.join(changes)), params)
+            records = rs.browse([record_id for record_id, in env.cr.fetchall()])
+            env.invalidate_all()
+            records.modified(names)
+            updated += len(records)
+        _logger.info('MIG: ... updated %s %s records' % (updated, rs._name))
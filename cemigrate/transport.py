@@ -0,0 +1,157 @@
+import os
+import gzip
+import json
+import time
+import random
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from odoolib import Connection
+from odoolib.main import Connector, JsonRPCException
+
+_logger = logging.getLogger(__name__)
+
+# model methods that only read: retried when they fail, the others could be applied twice
+READ_METHODS = frozenset(['search', 'read', 'search_read', 'search_count', 'read_group', 'name_get', 'name_search',
+                          'fields_get', 'default_get', 'context_get', 'check_access_rights'])
+# server errors that go away when the call is made again
+TRANSIENT_ERRORS = ('TransactionRollbackError', 'SerializationFailure', 'OperationalError', 'PoolError',
+                    'could not serialize access', 'concurrent update', 'too many connections')
+
+
+def _is_transient(error):
+    """True for errors of the server worth a retry: serialization failures, database pool exhausted..."""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in (429, 502, 503, 504)
+    if isinstance(error, JsonRPCException):
+        text = json.dumps(error.error, default=str) if isinstance(error.error, dict) else str(error.error)
+        return any(marker in text for marker in TRANSIENT_ERRORS)
+    return False
+
+
+class TransportStats(object):
+    """Calls, seconds, bytes and retries per remote method, e.g. ('object', 'res.partner', 'read').
+    Shared by a connector and its clones, so it is thread safe.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def record(self, key, seconds, sent, received, retries):
+        with self.lock:
+            stats = self.calls.get(key)
+            if stats is None:
+                stats = self.calls[key] = dict.fromkeys(
+                    ['calls', 'seconds', 'max_seconds', 'bytes_sent', 'bytes_received', 'retries'], 0)
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes_sent'] += sent
+            stats['bytes_received'] += received
+            stats['retries'] += retries
+
+    def as_dict(self):
+        with self.lock:
+            return {'%s %s' % (key[1] or key[0], key[2]): dict(
+                stats, average_seconds=round(stats['seconds'] / stats['calls'], 4))
+                for key, stats in sorted(self.calls.items(), key=lambda item: tuple(map(str, item[0])))}
+
+
+class PooledJsonRPCConnector(Connector):
+    """odoolib JSON-RPC connector keeping its HTTP connections open.
+
+    Requests go through a requests.Session per process: TLS handshakes are done once per pooled connection
+    instead of once per call. Responses are asked gzipped, requests are gzipped with compress_requests
+    (the server or its proxy must accept a gzipped body). Calls that only read are retried `retries` times
+    on network errors and transient server errors, waiting backoff * 2 ** attempt seconds. The time and
+    size of every call is recorded in `stats`.
+    """
+    PROTOCOL = 'jsonrpc'
+
+    def __init__(self, hostname, port=8069, secure=True, pool_size=10, compress_requests=False, retries=3,
+                 backoff=0.5, timeout=600, stats=None):
+        self.hostname = hostname
+        self.port = port
+        self.secure = secure
+        self.url = '%s://%s:%d/jsonrpc' % (secure and 'https' or 'http', hostname, port)
+        self.pool_size = pool_size
+        self.compress_requests = compress_requests
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.stats = stats or TransportStats()
+        self.local = threading.local()
+
+    def clone(self):
+        """Same settings and stats, its own connections, for another thread"""
+        return PooledJsonRPCConnector(self.hostname, self.port, self.secure, self.pool_size, self.compress_requests,
+                                      self.retries, self.backoff, self.timeout, self.stats)
+
+    @property
+    def session(self):
+        """Session of the current thread and process: a forked process must not share the sockets"""
+        if getattr(self.local, 'pid', None) != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'})
+            if self.compress_requests:
+                session.headers['Content-Encoding'] = 'gzip'
+            self.local.pid = os.getpid()
+            self.local.session = session
+        return self.local.session
+
+    def _post(self, body):
+        response = self.session.post(self.url, data=body, timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()
+        if result.get('error'):
+            raise JsonRPCException(result['error'])
+        # bytes on the wire, before decompression when gzipped
+        return result.get('result', False), int(response.headers.get('Content-Length') or len(response.content))
+
+    def send(self, service_name, method, *args):
+        data = json.dumps({'jsonrpc': '2.0', 'method': 'call', 'id': random.randint(0, 1000000000),
+                           'params': {'service': service_name, 'method': method, 'args': args}}).encode()
+        body = self.compress_requests and gzip.compress(data) or data
+        model_name, model_method = None, method
+        if service_name == 'object' and method == 'execute_kw':
+            model_name, model_method = args[3], args[4]
+        retries = self.retries if service_name != 'object' or model_method in READ_METHODS else 0
+        attempt, started = 0, time.perf_counter()
+        while True:
+            try:
+                result, received = self._post(body)
+                break
+            except (requests.RequestException, JsonRPCException) as e:
+                if attempt >= retries or not _is_transient(e):
+                    self.stats.record((service_name, model_name, model_method), time.perf_counter() - started,
+                                      len(body), 0, attempt)
+                    raise
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random() / 2)
+                attempt += 1
+                _logger.warning('MIG: ... %s %s failed (%s), retry %s/%s in %.1fs' % (
+                    model_name or service_name, model_method, e, attempt, retries, delay))
+                time.sleep(delay)
+        self.stats.record((service_name, model_name, model_method), time.perf_counter() - started,
+                          len(body), received, attempt)
+        return result
+
+
+def get_pooled_connection(hostname, protocol='jsonrpcs', port='auto', database=None, login=None, password=None,
+                          user_id=None, **options):
+    """Same as odoolib.get_connection, for jsonrpc and jsonrpcs, with a PooledJsonRPCConnector.
+    options are the ones of PooledJsonRPCConnector: pool_size, compress_requests, retries, backoff, timeout.
+    """
+    if protocol not in ('jsonrpc', 'jsonrpcs'):
+        raise ValueError('The pooled transport supports jsonrpc and jsonrpcs, not %s' % protocol)
+    if port == 'auto':
+        port = 8069
+    connector = PooledJsonRPCConnector(hostname, int(port), secure=protocol == 'jsonrpcs', **options)
+    return Connection(connector, database, login, password, user_id)
@@ -84,12 +84,12 @@ class MigrateTool(MigrateToolBase):
     def transform_mail_message(self, vals, key_fields):
         if vals.get('model', False):
             new_model_name = self._get_field_info_dict(vals['model'])['new_model_name']
-            rs1 = self.env[new_model_name].with_context(**DISABLED_MAIL_CONTEXT)
+            old_model_name = vals['model']
             vals['model'] = new_model_name
             if vals.get('res_id', False):
-                new_id = rs1.search([('x_mail_message_id', '=', vals['res_id'])])
+                new_id = self.map_old_id(old_model_name, vals['res_id'])
                 if new_id:
-                    vals['res_id'] = new_id.id
+                    vals['res_id'] = new_id
                 else:
                     vals = False
             else:
@@ -156,11 +156,14 @@ mt.init_import_models('hr.leave')
 mt.init_import_models('account.payment.term')
 mt.init_import_models('account.fiscal.position')
 
+# files and images of the records imported above, v12 image of res.partner is image_1920 in v16
+# mt.copy_attachments(['res.partner', 'crm.lead', 'hr.employee'], workers=8,
+#                     binary_fields={'res.partner': {'image': 'image_1920'}, 'hr.employee': {'image': 'image_1920'}})
+
 
 # # TODO: invoices
 # # set ir_config 'sequence.mixin.constraint_start_date', '1970-01-01'
 # mt.print_diff('account.invoice')
 # mt.init_import_models('account.invoice')
 # mt.import_basic_types('account.invoice', ['partner_id', 'date_invoice', 'user_id', 'fiscal_position_id', 'type', 'reference', 'number'])
-# # TODO: implement
-# mt.update_one2many_fields('account.invoice', 'line_ids')
+# mt.update_one2many_fields('account.invoice', 'invoice_line_ids', bulk=True)
@@ -8,7 +8,7 @@ setup(
     author_email='dduarte@erpgap.com',
     description='Migration tool for Odoo Community Edition',
     packages=["cemigrate"],
-    install_requires=['odoo-client-lib==1.2.2'],
+    install_requires=['odoo-client-lib==1.2.2', 'requests'],
     classifiers=[
         "License :: OSI Approved :: BSD License",
         "Programming Language :: Python",
@@ -0,0 +1,97 @@
+import re
+import unittest
+
+from cemigrate.sqlbatch import SqlCreateBatch, LOG_COLUMNS, NOW
+
+
+class Field(object):
+    store = True
+    inherited = False
+    compute = None
+    translate = False
+
+    def __init__(self, name, field_type='char', column_type=('varchar', 'varchar')):
+        self.name = name
+        self.type = field_type
+        self.column_type = column_type
+
+
+class Cursor(object):
+
+    def __init__(self):
+        self.queries = []
+        self.rows = []
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+
+    def fetchall(self):
+        return self.rows
+
+
+class Env(object):
+    uid = 7
+
+    def __init__(self):
+        self.cr = Cursor()
+
+    def flush_all(self):
+        pass
+
+    def invalidate_all(self):
+        pass
+
+    def add_to_compute(self, field, records):
+        pass
+
+
+class Recordset(object):
+    _name = 'res.partner.category'
+    _table = 'res_partner_category'
+    _log_access = True
+    _parent_store = False
+
+    def __init__(self, env, ids=()):
+        self.env = env
+        self.ids = list(ids)
+        self._fields = {name: Field(name) for name in ('id', 'name', 'x_res_partner_category_id') + LOG_COLUMNS}
+        self._fields['create_uid'].column_type = self._fields['write_uid'].column_type = ('int4', 'int4')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def browse(self, ids):
+        return Recordset(self.env, ids)
+
+    def default_get(self, names):
+        return {}
+
+    def modified(self, names, create=False):
+        pass
+
+
+class TestSqlCreateBatch(unittest.TestCase):
+
+    def test_log_columns(self):
+        rs = Recordset(Env())
+        rs.env.cr.rows = [(41, 1), (42, 2)]
+        batch = SqlCreateBatch(rs, 10, 'x_res_partner_category_id')
+        batch.add({'name': 'a', 'x_res_partner_category_id': 1})
+        batch.add({'name': 'b', 'x_res_partner_category_id': 2})
+        self.assertEqual(batch.flush().ids, [41, 42])
+        [(query, params)] = rs.env.cr.queries
+        columns = re.search(r'\((.*?)\) VALUES', query).group(1).replace('"', '').split(', ')
+        rows = re.search(r'VALUES (.*) ON CONFLICT', query).group(1)
+        row = re.match(r'\((.*?)\)(, |$)', rows.replace(NOW, 'NOW')).group(1).split(', ')
+        self.assertEqual(len(columns), len(row))
+        values, params = {}, list(params)
+        for column, placeholder in zip(columns, row):
+            values[column] = params.pop(0) if placeholder == '%s' else placeholder
+        self.assertEqual(values, {
+            'name': 'a', 'x_res_partner_category_id': 1,
+            'create_uid': 7, 'create_date': 'NOW', 'write_uid': 7, 'write_date': 'NOW'})
+        self.assertEqual(params, ['b', 2, 7, 7])
+
+
+if __name__ == '__main__':
+    unittest.main()